@@ -0,0 +1,63 @@
+import pygame
+import os
+import sys
+
+TILE_NAMES = ["ice1", "ice2", "ice3", "snow1", "snow2", "snow3", "cono", "start", "finish"]
+
+
+def resource_path(relative_path):
+    # Funziona sia in sviluppo che in build
+    if hasattr(sys, '_MEIPASS'):
+        return os.path.join(sys._MEIPASS, relative_path)
+    return os.path.join(os.path.abspath("."), relative_path)
+
+
+class AssetRegistry:
+    """Loads and scales each image once per (path, scale) and hands out shared copies"""
+
+    def __init__(self):
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, key):
+        value = self.cache.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def image(self, path, scale=1.0):
+        key = ("image", path, scale)
+        img = self._lookup(key)
+        if img is None:
+            img = pygame.image.load(resource_path(path)).convert_alpha()
+            if scale != 1.0:
+                new_size = (int(img.get_width() * scale), int(img.get_height() * scale))
+                img = pygame.transform.scale(img, new_size)
+            self.cache[key] = img
+        return img
+
+    def frames(self, path, scale=1.0):
+        """All .png frames in a folder, sorted by name, as a tuple"""
+        key = ("frames", path, scale)
+        frames = self._lookup(key)
+        if frames is None:
+            frames = tuple(self.image(os.path.join(path, fname), scale)
+                           for fname in sorted(os.listdir(resource_path(path)))
+                           if fname.endswith(".png"))
+            self.cache[key] = frames
+        return frames
+
+    def tiles(self, scale=1.0):
+        """{tile name: Surface} for every road tile"""
+        return {name: self.image(f"assets/images/roadstuff/{name}.png", scale)
+                for name in TILE_NAMES}
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.cache)}
+
+
+# Process-wide registry
+assets = AssetRegistry()
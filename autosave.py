@@ -0,0 +1,220 @@
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+from trackgrid import TrackGrid
+from trackfile import load_track, save_track, journal_path, drop_journal
+
+AUTOSAVE_SECONDS = 5.0
+COMPACT_BYTES = 1024 * 1024  # fold the journal into the track file past this size
+DIRTY_CHUNK = 32             # dirty regions are DIRTY_CHUNK x DIRTY_CHUNK tiles
+
+# Journal (<track path>.journal) is a list of records, each holding the
+# current contents of the regions edited since the previous one:
+#   record   u32 payload length, u32 crc32 of the payload, payload
+#   payload  grid width, height, palette size, palette (u8 length + name),
+#            region count, per region x, y, w, h + w*h tile ids
+# A record that was cut short by a crash fails its crc and ends the replay.
+RECORD = struct.Struct("<II")
+GRID = struct.Struct("<IIB")
+COUNT = struct.Struct("<I")
+REGION = struct.Struct("<IIII")
+
+
+def encode_record(width, height, palette, regions):
+    parts = [GRID.pack(width, height, len(palette))]
+    for name in palette:
+        encoded = name.encode("utf-8")
+        parts.append(bytes([len(encoded)]) + encoded)
+    parts.append(COUNT.pack(len(regions)))
+    for x, y, w, h, data in regions:
+        parts.append(REGION.pack(x, y, w, h))
+        parts.append(data)
+    payload = b"".join(parts)
+    return RECORD.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def read_journal(path):
+    """(width, height, palette, regions) for every complete record"""
+    try:
+        with open(path, "rb") as f:
+            buf = f.read()
+    except FileNotFoundError:
+        return []
+    records = []
+    offset = 0
+    while offset + RECORD.size <= len(buf):
+        length, crc = RECORD.unpack_from(buf, offset)
+        payload = buf[offset + RECORD.size:offset + RECORD.size + length]
+        if len(payload) != length or zlib.crc32(payload) != crc:
+            break
+        offset += RECORD.size + length
+
+        width, height, count = GRID.unpack_from(payload, 0)
+        pos = GRID.size
+        palette = []
+        for _ in range(count):
+            n = payload[pos]
+            palette.append(payload[pos+1:pos+1+n].decode("utf-8"))
+            pos += 1 + n
+        (nregions,) = COUNT.unpack_from(payload, pos)
+        pos += COUNT.size
+        regions = []
+        for _ in range(nregions):
+            x, y, w, h = REGION.unpack_from(payload, pos)
+            pos += REGION.size
+            regions.append((x, y, w, h, payload[pos:pos + w*h]))
+            pos += w*h
+        records.append((width, height, palette, regions))
+    return records
+
+
+def replay_journal(grid, path):
+    """Apply the journal on top of grid, returns the number of records used"""
+    records = read_journal(path)
+    for width, height, palette, regions in records:
+        if (width, height) != (grid.width, grid.height):
+            print(f"Journal {path} is for a {width}x{height} track, ignoring it")
+            return 0
+        # Journal palette ids to this grid's ids
+        ids = bytearray(range(256))
+        ids[:len(palette)] = bytes(grid.tile_id(name) for name in palette)
+        for x, y, w, h, data in regions:
+            grid.write_cells([(y + r)*grid.width + x + c for r in range(h) for c in range(w)],
+                             data.translate(ids))
+    return len(records)
+
+
+def recover_track(path):
+    """Load a track plus any edits autosaved after its last save.
+    Returns (grid, records replayed)."""
+    grid = load_track(path, paged=False)
+    return grid, replay_journal(grid, journal_path(path))
+
+
+class Autosaver:
+    """Saves a TrackGrid from a background thread.
+
+    Edits are reported with mark(). Every interval the dirty regions are
+    copied (on the calling thread, so the copy is consistent) and appended
+    to the journal by the writer thread. save() folds everything into the
+    track file: written to a temp file, then renamed over the old one.
+
+    The journal is flushed right before every compaction snapshot, so if
+    the journal outlives the rename (crash in between) replaying it over
+    the new file changes nothing.
+    """
+
+    def __init__(self, path, grid, interval=AUTOSAVE_SECONDS):
+        self.path = path
+        self.journal = journal_path(path)
+        self.grid = grid
+        self.interval = interval
+        self.dirty = set()  # {(chunk x, chunk y)}
+        self.last_flush = time.monotonic()
+        try:
+            self.journal_bytes = os.path.getsize(self.journal)
+        except OSError:
+            self.journal_bytes = 0
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    @property
+    def busy(self):
+        return self.jobs.unfinished_tasks > 0
+
+    @property
+    def unsaved(self):
+        """Edits since the last save, journaled or not (exact once closed)"""
+        return bool(self.dirty) or self.journal_bytes > 0
+
+    def mark(self, indices):
+        w, c = self.grid.width, DIRTY_CHUNK
+        self.dirty.update({(i % w // c, i // w // c) for i in indices})
+
+    def update(self):
+        """Call once a frame, journals the dirty regions every interval"""
+        if time.monotonic() - self.last_flush < self.interval:
+            return
+        self.flush()
+        if self.journal_bytes > COMPACT_BYTES:
+            self.save()
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if not self.dirty:
+            return
+        grid = self.grid
+        cells, gw = grid.cells, grid.width
+        regions = []
+        for cx, cy in sorted(self.dirty):
+            x0, y0 = cx*DIRTY_CHUNK, cy*DIRTY_CHUNK
+            x1, y1 = min(gw, x0 + DIRTY_CHUNK), min(grid.height, y0 + DIRTY_CHUNK)
+            data = b"".join(cells[y*gw + x0:y*gw + x1] for y in range(y0, y1))
+            regions.append((x0, y0, x1 - x0, y1 - y0, data))
+        self.dirty = set()
+        self.jobs.put(("journal", encode_record(gw, grid.height, grid.palette, regions)))
+
+    def save(self):
+        """Write the whole track file in the background"""
+        self.flush()
+        grid = self.grid
+        self.jobs.put(("compact", grid.width, grid.height, list(grid.palette), bytearray(grid.cells)))
+
+    def discard(self):
+        """Forget unsaved edits (the track is being reloaded from its file)"""
+        self.dirty = set()
+        self.jobs.put(("discard",))
+        self.wait()
+
+    def wait(self):
+        """Block until the writer is done with every queued job, so the
+        track file on disk is the one the last save() wrote"""
+        self.jobs.join()
+
+    def close(self):
+        """Journal what is left and wait for the writer"""
+        self.flush()
+        self.jobs.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                if job[0] == "journal":
+                    self._append(job[1])
+                elif job[0] == "compact":
+                    self._compact(*job[1:])
+                else:
+                    self._remove_journal()
+            except OSError as e:
+                print(f"Autosave of {self.path} failed: {e}")
+            finally:
+                self.jobs.task_done()
+
+    def _append(self, record):
+        with open(self.journal, "ab") as f:
+            f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal_bytes += len(record)
+
+    def _compact(self, width, height, palette, cells):
+        root, ext = os.path.splitext(self.path)
+        tmp = root + ".tmp" + ext  # same extension, save_track picks the format from it
+        save_track(tmp, TrackGrid(width, height, palette, cells))
+        with open(tmp, "rb+") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self._remove_journal()
+        print(f"Map saved to {self.path}!")
+
+    def _remove_journal(self):
+        drop_journal(self.path)
+        self.journal_bytes = 0
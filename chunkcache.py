@@ -0,0 +1,129 @@
+import pygame
+from collections import OrderedDict
+
+# Chunks are sized in pixels so high resolutions don't end up with huge surfaces
+# (16x16 tiles at 32px, 6x6 tiles at 85px)
+CHUNK_PIXELS = 512
+MAX_CACHE_BYTES = 64 * 1024 * 1024
+
+
+class ChunkCache:
+    """Bakes the track grid into chunk surfaces so the map is drawn with a few blits"""
+
+    def __init__(self, grid, tiles, tilesize, bg_color=(30,40,55),
+                 chunk_tiles=None, max_bytes=MAX_CACHE_BYTES):
+        self.grid = grid
+        self.tiles = tiles
+        self.tilesize = tilesize
+        self.bg_color = bg_color
+        self.mapw, self.maph = grid.width, grid.height
+        if chunk_tiles is None:
+            chunk_tiles = max(1, CHUNK_PIXELS // tilesize)
+        self.chunk_tiles = chunk_tiles
+        self.chunk_px = chunk_tiles * tilesize
+        self.max_bytes = max_bytes
+
+        # {(cx, cy): Surface}, least recently used first
+        self.chunks = OrderedDict()
+        self.used_bytes = 0
+
+    def _bake(self, cx, cy):
+        ct = self.chunk_tiles
+        x0, y0 = cx*ct, cy*ct
+        x1, y1 = min(self.mapw, x0+ct), min(self.maph, y0+ct)
+        surf = pygame.Surface(((x1-x0)*self.tilesize, (y1-y0)*self.tilesize))
+        if pygame.display.get_surface() is not None:
+            surf = surf.convert()
+        surf.fill(self.bg_color)
+        surfs = [self.tiles[name] for name in self.grid.palette]
+        cells = self.grid.cells
+        for y in range(y0, y1):
+            row = cells[y*self.mapw + x0:y*self.mapw + x1]
+            draw_y = (y-y0)*self.tilesize
+            surf.blits([(surfs[tid], (i*self.tilesize, draw_y))
+                        for i, tid in enumerate(row)], False)
+        return surf
+
+    def _surface_bytes(self, surf):
+        return surf.get_width() * surf.get_height() * surf.get_bytesize()
+
+    def get_chunk(self, cx, cy):
+        key = (cx, cy)
+        surf = self.chunks.get(key)
+        if surf is not None:
+            self.chunks.move_to_end(key)
+            return surf
+        surf = self._bake(cx, cy)
+        self.chunks[key] = surf
+        self.used_bytes += self._surface_bytes(surf)
+        return surf
+
+    def _evict(self, keep):
+        # Never evict chunks that are on screen this frame
+        while self.used_bytes > self.max_bytes:
+            for key in self.chunks:
+                if key not in keep:
+                    break
+            else:
+                return
+            surf = self.chunks.pop(key)
+            self.used_bytes -= self._surface_bytes(surf)
+
+    def _drop(self, key):
+        surf = self.chunks.pop(key, None)
+        if surf is not None:
+            self.used_bytes -= self._surface_bytes(surf)
+
+    def invalidate(self, x, y):
+        """Drop the chunk holding tile (x, y) so it gets baked again"""
+        self._drop((x // self.chunk_tiles, y // self.chunk_tiles))
+
+    def invalidate_cells(self, indices):
+        """Drop every chunk holding one of the cell indices, each chunk once"""
+        ct, w = self.chunk_tiles, self.mapw
+        for key in {(i % w // ct, i // w // ct) for i in indices}:
+            self._drop(key)
+
+    def clear(self):
+        self.chunks.clear()
+        self.used_bytes = 0
+
+    def draw(self, surface, cam_x, cam_y, view_width, view_height):
+        cp = self.chunk_px
+        start_cx = max(0, cam_x // cp)
+        start_cy = max(0, cam_y // cp)
+        end_cx = min((self.mapw - 1) // self.chunk_tiles, (cam_x + view_width - 1) // cp)
+        end_cy = min((self.maph - 1) // self.chunk_tiles, (cam_y + view_height - 1) // cp)
+
+        visible = set()
+        for cy in range(start_cy, end_cy + 1):
+            for cx in range(start_cx, end_cx + 1):
+                surface.blit(self.get_chunk(cx, cy), (cx*cp - cam_x, cy*cp - cam_y))
+                visible.add((cx, cy))
+        self._evict(visible)
+
+
+class GridOverlay:
+    """Tile grid lines pre-rendered once for a whole view, scrolled with the camera"""
+
+    KEY = (255, 0, 255)
+
+    def __init__(self, tilesize, view_width, view_height, color=(50,50,50)):
+        self.tilesize = tilesize
+        cols = view_width // tilesize + 2
+        rows = view_height // tilesize + 2
+        self.layer = pygame.Surface((cols*tilesize, rows*tilesize))
+        self.layer.fill(self.KEY)
+        for y in range(rows):
+            for x in range(cols):
+                pygame.draw.rect(self.layer, color, (x*tilesize, y*tilesize, tilesize, tilesize), 1)
+        self.layer.set_colorkey(self.KEY)
+
+    def draw(self, surface, cam_x, cam_y, mapw, maph):
+        """Grid over the map area only (mapw, maph in tiles)"""
+        ts = self.tilesize
+        map_rect = pygame.Rect(-cam_x, -cam_y, mapw*ts, maph*ts)
+        old_clip = surface.get_clip()
+        surface.set_clip(map_rect.clip(old_clip))
+        surface.blit(self.layer, (-(cam_x % ts), -(cam_y % ts)))
+        surface.set_clip(old_clip)
@@ -1,10 +1,69 @@
 import socket
-import json
 import threading
 import time
+from itertools import islice
+from collections import deque, namedtuple, OrderedDict
+from types import MappingProxyType
+from protocol import apply_snapshot, decode, dequantize, encode
+
+# Received snapshots kept as baselines for the server's deltas
+SNAPSHOT_HISTORY = 32
+
+# Remote players are drawn INTERP_DELAY behind the newest snapshot, between
+# the two samples around that time. Past the newest sample they are moved
+# on by their velocity for at most MAX_EXTRAPOLATION.
+INTERP_DELAY = 0.1
+MAX_EXTRAPOLATION = 0.25
+INTERP_BUFFER = 16
+CLOCK_DRIFT = 0.0005  # how fast the clock offset estimate may fall, per snapshot
+
+# Input mode: frames the server hasn't confirmed are kept for replay and
+# resent with every input packet, oldest first (up to MAX_INPUT_FRAMES of
+# them). Prediction stops at MAX_PENDING_INPUTS rather than drop any.
+MAX_PENDING_INPUTS = 256
+MAX_INPUT_FRAMES = 32
+
+
+def interpolate(samples, t):
+    """Player state at time t from a list of (time, x, y, angle, vx, vy, crashes)"""
+    newest = samples[-1]
+    if t >= newest[0]:
+        _, x, y, angle, vx, vy, crashes = newest
+        ahead = min(t - newest[0], MAX_EXTRAPOLATION)
+        return {'x': x + vx*ahead, 'y': y + vy*ahead, 'angle': angle,
+                'vx': vx, 'vy': vy, 'crashes': crashes}
+    
+    a = b = samples[0]
+    for i in range(len(samples) - 1, 0, -1):
+        a, b = samples[i-1], samples[i]
+        if a[0] <= t:
+            break
+    if t <= a[0] or b[0] <= a[0]:
+        f = 0.0
+    else:
+        f = (t - a[0]) / (b[0] - a[0])
+    # Turn the short way round
+    turn = (b[3] - a[3] + 180) % 360 - 180
+    return {
+        'x': a[1] + (b[1] - a[1]) * f,
+        'y': a[2] + (b[2] - a[2]) * f,
+        'angle': a[3] + turn * f,
+        'vx': a[4] + (b[4] - a[4]) * f,
+        'vy': a[5] + (b[5] - a[5]) * f,
+        'crashes': b[6] if f >= 1.0 else a[6]
+    }
+
+# What the receive thread publishes about the other players. A new one is
+# built for every state or snapshot and swapped in with a single assignment,
+# so the game loop reads it without locks or copies and never sees it half
+# built. version goes up by one per publish.
+#   players: {id: {'x', 'y', 'angle', 'vx', 'vy', 'crashes'}}
+#   history: {id: tuple of (server time, x, y, angle, vx, vy, crashes)}
+RemoteState = namedtuple('RemoteState', 'version players history')
+EMPTY = MappingProxyType({})
 
 class GameClient:
-    def __init__(self, server_address='127.0.0.1:5555'):
+    def __init__(self, server_address='127.0.0.1:5555', binary=True, inputs=True):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.settimeout(0.1)
         
@@ -24,39 +83,73 @@ class GameClient:
         self.server_addr = (host, port)
         print(f"Client configured for {host}:{port}")
         
+        # Binary protocol, falls back to JSON if the server doesn't answer
+        self.binary = binary
+        # Ask the server to simulate us from our inputs (if it can)
+        self.inputs = inputs
+        self.input_mode = False
         self.player_id = None
-        self.other_players = {}  # {id: {'x', 'y', 'angle', 'vx', 'vy', 'crashes'}}
+        self.remote = RemoteState(0, EMPTY, EMPTY)
+        self.published_time = None  # server time of the last publish
         self.connected = False
         self.track_name = None
         
+        # {tick: {id: quantized fields}}, the newest tick is acked in every update
+        self.snapshots = OrderedDict()
+        self.last_tick = 0
+        
+        # Estimated server time minus local time, for interpolation
+        self.clock_offset = None
+        
+        # Prediction: (seq, bits) not yet confirmed by the server, and
+        # the newest authoritative state of our own skater
+        self.next_seq = 1
+        self.pending_inputs = deque()
+        self.server_state = None
+        self.reconciled_seq = 0
+        
         self.running = True
         self.receive_thread = threading.Thread(target=self._receive_loop, daemon=True)
         self.receive_thread.start()
     
-    def connect(self, spawn_x, spawn_y, spawn_angle):
-        """Send join request to server"""
+    def connect(self, spawn_x, spawn_y, spawn_angle, track=None, scale=1.0):
+        """Send join request to server, asking for a room on the given track"""
         join_msg = {
             'type': 'join',
             'x': spawn_x,
             'y': spawn_y,
-            'angle': spawn_angle
+            'angle': spawn_angle,
+            'inputs': self.inputs,
+            'scale': scale,
+            'track': track
         }
-        try:
-            self.sock.sendto(json.dumps(join_msg).encode('utf-8'), self.server_addr)
-        except socket.gaierror as e:
-            print(f"Failed to resolve server address: {e}")
-            return False
-        except Exception as e:
-            print(f"Connection error: {e}")
+        if not self._send_join(join_msg):
             return False
         
         # Wait for welcome message (with timeout)
         start_time = time.time()
         while not self.connected and time.time() - start_time < 3.0:
+            if self.binary and time.time() - start_time >= 1.5:
+                # No answer to the binary join, try the JSON protocol
+                print("No reply to binary join, retrying with JSON")
+                self.binary = False
+                if not self._send_join(join_msg):
+                    return False
             time.sleep(0.1)
         
         return self.connected
     
+    def _send_join(self, join_msg):
+        try:
+            self.sock.sendto(encode(join_msg, self.binary), self.server_addr)
+        except socket.gaierror as e:
+            print(f"Failed to resolve server address: {e}")
+            return False
+        except Exception as e:
+            print(f"Connection error: {e}")
+            return False
+        return True
+    
     def send_update(self, x, y, angle, vx, vy, crashes):
         """Send player position update to server"""
         if not self.connected:
@@ -69,18 +162,67 @@ class GameClient:
             'angle': angle,
             'vx': vx,
             'vy': vy,
-            'crashes': crashes
+            'crashes': crashes,
+            'ack': self.last_tick
+        }
+        try:
+            self.sock.sendto(encode(update_msg, self.binary), self.server_addr)
+        except Exception as e:
+            print(f"Send error: {e}")
+    
+    def add_input(self, bits):
+        """Record the input of one predicted physics step, sent by send_inputs.
+        Returns False, without recording it, once MAX_PENDING_INPUTS are
+        waiting for the server: the step must not be predicted then."""
+        if len(self.pending_inputs) >= MAX_PENDING_INPUTS:
+            return False
+        self.pending_inputs.append((self.next_seq, bits))
+        self.next_seq += 1
+        return True
+    
+    def send_inputs(self):
+        """Send the input frames the server hasn't confirmed yet"""
+        # Frames the server has confirmed don't need resending
+        state = self.server_state
+        while state is not None and self.pending_inputs and self.pending_inputs[0][0] <= state['seq']:
+            self.pending_inputs.popleft()
+        if not self.connected or not self.pending_inputs:
+            return
+        
+        # Oldest first, the server only simulates frames in order
+        frames = list(islice(self.pending_inputs, MAX_INPUT_FRAMES))
+        input_msg = {
+            'type': 'input',
+            'ack': self.last_tick,
+            'seq': frames[0][0],
+            'frames': [bits for _, bits in frames]
         }
         try:
-            self.sock.sendto(json.dumps(update_msg).encode('utf-8'), self.server_addr)
+            self.sock.sendto(encode(input_msg, self.binary), self.server_addr)
         except Exception as e:
             print(f"Send error: {e}")
     
+    def reconcile(self, skater, simulate):
+        """Move the predicted skater to the server's newest state and replay
+        the inputs it hasn't seen yet. simulate(skater, bits) runs one
+        physics step. Returns True if a new server state was applied."""
+        state = self.server_state
+        if state is None or state['seq'] <= self.reconciled_seq:
+            return False
+        self.reconciled_seq = state['seq']
+        
+        while self.pending_inputs and self.pending_inputs[0][0] <= state['seq']:
+            self.pending_inputs.popleft()
+        skater.set_state(state)
+        for _, bits in self.pending_inputs:
+            simulate(skater, bits)
+        return True
+    
     def disconnect(self):
         """Notify server of disconnect"""
         leave_msg = {'type': 'leave'}
         try:
-            self.sock.sendto(json.dumps(leave_msg).encode('utf-8'), self.server_addr)
+            self.sock.sendto(encode(leave_msg, self.binary), self.server_addr)
         except:
             pass
         self.running = False
@@ -90,25 +232,36 @@ class GameClient:
         """Background thread to receive server messages"""
         while self.running:
             try:
-                data, addr = self.sock.recvfrom(4096)
-                msg = json.loads(data.decode('utf-8'))
+                data, addr = self.sock.recvfrom(65535)
+                msg = decode(data)
                 msg_type = msg.get('type')
                 
                 if msg_type == 'welcome':
                     # Server acknowledged connection
                     self.player_id = msg.get('id')
-                    self.track_name = msg.get('track', 'track1.json')
+                    self.track_name = msg.get('track', 'track1.trk')
+                    self.input_mode = msg.get('inputs', False)
                     self.connected = True
                     print(f"Connected to server! Player ID: {self.player_id}")
                     print(f"Track: {self.track_name}")
+                    if self.input_mode:
+                        print("Server simulates our inputs")
+                
+                elif msg_type == 'player_state':
+                    # Authoritative state of our own skater, applied by reconcile
+                    if self.server_state is None or msg['seq'] > self.server_state['seq']:
+                        self.server_state = msg
                 
                 elif msg_type == 'state':
                     # Update other players' positions
                     players = msg.get('players', [])
-                    self.other_players.clear()
+                    # Servers without timestamps: use arrival time
+                    server_time = msg.get('time', time.perf_counter())
+                    self._sync_clock(server_time)
+                    others = {}
                     for p in players:
                         if p['id'] != self.player_id:
-                            self.other_players[p['id']] = {
+                            others[p['id']] = {
                                 'x': p['x'],
                                 'y': p['y'],
                                 'angle': p['angle'],
@@ -116,6 +269,35 @@ class GameClient:
                                 'vy': p.get('vy', 0),
                                 'crashes': p.get('crashes', 0)
                             }
+                    self._publish(server_time, others, others)
+                
+                elif msg_type == 'snapshot':
+                    tick = msg['tick']
+                    if tick <= self.last_tick:
+                        continue  # Late or duplicate packet
+                    baseline = {}
+                    if msg['baseline']:
+                        baseline = self.snapshots.get(msg['baseline'])
+                        if baseline is None:
+                            continue  # Baseline already dropped, wait for the next one
+                    snapshot = apply_snapshot(msg, baseline)
+                    previous = self.snapshots.get(self.last_tick, {})
+                    self.snapshots[tick] = snapshot
+                    while len(self.snapshots) > SNAPSHOT_HISTORY:
+                        self.snapshots.popitem(last=False)
+                    self.last_tick = tick
+                    self._sync_clock(msg['time'])
+                    
+                    others = {}
+                    changed = {}
+                    for pid, fields in snapshot.items():
+                        if pid != self.player_id:
+                            others[pid] = dequantize(fields)
+                            # Only real updates go in the buffer, AOI keeps far
+                            # players unchanged between refreshes
+                            if fields != previous.get(pid):
+                                changed[pid] = others[pid]
+                    self._publish(msg['time'], others, changed)
             
             except socket.timeout:
                 continue
@@ -124,9 +306,56 @@ class GameClient:
                     print(f"Receive error: {e}")
                 break
     
+    def _sync_clock(self, server_time):
+        # Track the lowest-latency sample, letting the estimate slowly fall
+        # so it follows clock drift
+        offset = server_time - time.perf_counter()
+        if self.clock_offset is None:
+            self.clock_offset = offset
+        else:
+            self.clock_offset = max(offset, self.clock_offset - CLOCK_DRIFT)
+    
+    def _publish(self, server_time, others, changed):
+        """Swap in a new RemoteState. changed are the players with a new
+        sample at server_time, players not in others are dropped."""
+        old = self.remote.history
+        previous = self.published_time
+        history = {}
+        for pid in others:
+            samples = old.get(pid, ())
+            p = changed.get(pid)
+            if p is not None:
+                if samples and previous is not None and samples[-1][0] < previous:
+                    # Unchanged until the previous state: hold there, so
+                    # the move isn't blended over the whole time it stood
+                    samples += ((previous,) + samples[-1][1:],)
+                sample = (server_time, p['x'], p['y'], p['angle'], p['vx'], p['vy'], p['crashes'])
+                samples = (samples + (sample,))[-INTERP_BUFFER:]
+            history[pid] = samples
+        self.remote = RemoteState(self.remote.version + 1, MappingProxyType(others),
+                                  MappingProxyType(history))
+        self.published_time = server_time
+    
+    def get_remote(self):
+        """Latest RemoteState, shared and read-only"""
+        return self.remote
+    
     def get_other_players(self):
-        """Get dictionary of other players' states"""
-        return self.other_players.copy()
+        """Get the other players' states (read-only)"""
+        return self.remote.players
+    
+    def get_interpolated_players(self, delay=INTERP_DELAY, remote=None):
+        """Other players' states at a slightly delayed server time, for smooth drawing"""
+        if remote is None:
+            remote = self.remote
+        if self.clock_offset is None:
+            return {}
+        render_time = time.perf_counter() + self.clock_offset - delay
+        players = {}
+        for pid, samples in remote.history.items():
+            if samples:
+                players[pid] = interpolate(samples, render_time)
+        return players
     
     def is_connected(self):
         return self.connected
\ No newline at end of file
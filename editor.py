@@ -1,11 +1,12 @@
-import pygame, json, sys
-import os
-
-def resource_path(relative_path):
-    # Funziona sia in sviluppo che in build
-    if hasattr(sys, '_MEIPASS'):
-        return os.path.join(sys._MEIPASS, relative_path)
-    return os.path.join(os.path.abspath("."), relative_path)
+import pygame, sys
+from assets import assets
+from trackgrid import TrackGrid
+from trackfile import load_track
+from autosave import Autosaver, recover_track
+from chunkcache import ChunkCache, GridOverlay
+from edittools import EditHistory, brush_cells, line_cells, rect_cells, flood_cells, MAX_BRUSH
+from hudtext import hud_text
+
 # Load resolution setting
 def load_resolution():
     try:
@@ -32,84 +33,123 @@ pygame.display.set_caption("Ice Drift Editor")
 clock = pygame.time.Clock()
 
 # Load and scale tiles
-def load_scaled_tile(path):
-    img = pygame.image.load(resource_path(path))
-    if SCALE != 1.0:
-        new_size = (int(img.get_width() * SCALE), int(img.get_height() * SCALE))
-        img = pygame.transform.scale(img, new_size)
-    return img
-
-tiles = {
-    "ice1": load_scaled_tile("assets/images/roadstuff/ice1.png"),
-    "ice2": load_scaled_tile("assets/images/roadstuff/ice2.png"),
-    "ice3": load_scaled_tile("assets/images/roadstuff/ice3.png"),
-    "snow1": load_scaled_tile("assets/images/roadstuff/snow1.png"),
-    "snow2": load_scaled_tile("assets/images/roadstuff/snow2.png"),
-    "snow3": load_scaled_tile("assets/images/roadstuff/snow3.png"),
-    "cono": load_scaled_tile("assets/images/roadstuff/cono.png"),
-    "start": load_scaled_tile("assets/images/roadstuff/start.png"),
-    "finish": load_scaled_tile("assets/images/roadstuff/finish.png"),
-}
+tiles = assets.tiles(SCALE)
+
+BG_COLOR = (100,100,100)
+font = pygame.font.SysFont("consolas", int(20 * SCALE))
+# Grid lines are drawn once and scrolled with the camera
+grid_overlay = GridOverlay(TILESIZE, SCREENW, SCREENH)
 
 def game_loop():
     global tiles  # Access tiles from outer scope
     
     # These need to be local to game_loop
     current_tile = "ice1"
-    grid = [["ice1" for x in range(MAPW)] for y in range(MAPH)]
+    grid = TrackGrid.filled(MAPW, MAPH, "ice1")
     cam_x, cam_y = 0, 0
     dragging = False
     last_mouse = (0,0)
+    tool = "brush"  # brush, rect or fill
+    brush_size = 1
+    painting = False
+    last_cell = None
+    rect_anchor = None
 
     # Load selected map
     try:
         with open("selected.txt","r") as f:
             selected_map = f.readline().strip()
     except:
-        selected_map = "track1.json"
+        selected_map = "track1.trk"
+
+    # Only the chunks on screen are drawn, edits re-bake just their chunk
+    chunk_cache = ChunkCache(grid, tiles, TILESIZE, BG_COLOR)
+    # Every tool writes through the history, one undo step per operation
+    history = EditHistory(grid)
+    # Edits are journaled and saved from a background thread
+    autosave = Autosaver("maps/" + selected_map, grid)
+
+    def cell_at(pos):
+        return (pos[0]+cam_x)//TILESIZE, (pos[1]+cam_y)//TILESIZE
+
+    def changed(indices):
+        chunk_cache.invalidate_cells(indices)
+        autosave.mark(indices)
+
+    def paint(indices, name):
+        changed(history.write(indices, name))
+
+    def place_start(x, y):
+        # Only one start, the old one goes back to ice
+        w = grid.width
+        history.begin()
+        paint([sy*w + sx for sx, sy in grid.starts], "ice1")
+        paint([y*w + x], "start")
+        history.end()
 
     def draw_grid():
-        screen.fill((100,100,100))
-        for y in range(MAPH):
-            for x in range(MAPW):
-                draw_x = x*TILESIZE - cam_x
-                draw_y = y*TILESIZE - cam_y
-                if -TILESIZE < draw_x < SCREENW and -TILESIZE < draw_y < SCREENH:
-                    screen.blit(tiles[grid[y][x]], (draw_x, draw_y))
-                    pygame.draw.rect(screen, (50,50,50),
-                                     (draw_x, draw_y, TILESIZE, TILESIZE), 1)
-        
+        screen.fill(BG_COLOR)
+        chunk_cache.draw(screen, cam_x, cam_y, SCREENW, SCREENH)
+        grid_overlay.draw(screen, cam_x, cam_y, grid.width, grid.height)
+
+        # Outline of what the tool will paint
+        gx, gy = cell_at(pygame.mouse.get_pos())
+        if rect_anchor is not None:
+            ax, ay = rect_anchor
+            x0, y0 = min(ax, gx), min(ay, gy)
+            outline = (x0, y0, abs(gx-ax) + 1, abs(gy-ay) + 1)
+        elif tool == "brush" and current_tile != "start":
+            half = (brush_size - 1)//2
+            outline = (gx - half, gy - half, brush_size, brush_size)
+        else:
+            outline = (gx, gy, 1, 1)
+        pygame.draw.rect(screen, (255,255,255),
+                         (outline[0]*TILESIZE - cam_x, outline[1]*TILESIZE - cam_y,
+                          outline[2]*TILESIZE, outline[3]*TILESIZE), max(1, int(2*SCALE)))
+
         # Draw current tile indicator
-        font_size = int(20 * SCALE)
-        font = pygame.font.SysFont("consolas", font_size)
-        text = font.render(f"Current: {current_tile}", True, (255,255,255))
-        screen.blit(text, (int(10*SCALE), SCREENH - int(30*SCALE)))
-
-    def save_map(filename=None):
-        if filename is None:
-            filename = "maps/" + selected_map
-        with open(filename,"w") as f:
-            json.dump(grid,f)
-        print(f"Map saved to {filename}!")
-
-    def load_map(filename=None):
-        nonlocal grid  # Modify the grid variable from outer scope
-        if filename is None:
-            filename = "maps/" + selected_map
+        tool_name = f"brush {brush_size}" if tool == "brush" else tool
+        status = f"Current: {current_tile}  Tool: {tool_name}"
+        if autosave.busy:
+            status += "  Saving..."
+        elif autosave.unsaved:
+            status += "  Unsaved (S save, D discard)"
+        hud_text.draw(screen, font, status, (255,255,255),
+                      (int(10*SCALE), SCREENH - int(30*SCALE)))
+
+    def save_map():
+        # Written in the background, the writer prints when it is done
+        autosave.save()
+
+    def load_map(recover=False):
+        nonlocal grid, chunk_cache, history  # Modify the grid variable from outer scope
+        filename = autosave.path
+        # A save may still be writing the file, read it once that is done
+        autosave.wait()
         try:
-            with open(filename,"r") as f:
-                loaded = json.load(f)
-                # Handle empty or malformed files
-                if loaded and len(loaded) > 0 and len(loaded[0]) > 0:
-                    grid = loaded
-                    print(f"Map loaded from {filename}!")
-                else:
-                    print("Empty map file, starting fresh")
+            if recover:
+                # Bring back edits autosaved after the last save
+                loaded, records = recover_track(filename)
+            else:
+                # Reloading throws away the unsaved edits
+                autosave.discard()
+                loaded, records = load_track(filename, paged=False), 0
+            # Handle empty or malformed files
+            if loaded.width > 0 and loaded.height > 0:
+                grid = loaded
+                chunk_cache = ChunkCache(grid, tiles, TILESIZE, BG_COLOR)
+                history = EditHistory(grid)
+                autosave.grid = grid
+                print(f"Map loaded from {filename}!")
+                if records:
+                    print(f"Recovered {records} autosaves of unsaved edits (S saves them, D discards them)")
+            else:
+                print("Empty map file, starting fresh")
         except:
             print(f"Failed to load map from {filename}!")
 
     # Try to load the selected map at start
-    load_map()
+    load_map(recover=True)
 
     running=True
     while running:
@@ -121,6 +161,10 @@ def game_loop():
                     running=False
                 if event.key==pygame.K_s: save_map()
                 if event.key==pygame.K_l: load_map()
+                if event.key==pygame.K_d and not event.mod & pygame.KMOD_CTRL:
+                    # Back to the last save, the autosaved edits are dropped
+                    load_map()
+                    print("Unsaved edits discarded")
                 if event.key==pygame.K_1: current_tile="ice1"
                 if event.key==pygame.K_2: current_tile="ice2"
                 if event.key==pygame.K_3: current_tile="ice3"
@@ -130,26 +174,59 @@ def game_loop():
                 if event.key==pygame.K_c: current_tile="cono"
                 if event.key==pygame.K_f: current_tile="finish"
                 if event.key==pygame.K_p: current_tile="start"
+                # Tools: B brush, R rectangle, G flood fill, [ and ] brush size
+                if event.key==pygame.K_b: tool="brush"
+                if event.key==pygame.K_r: tool="rect"
+                if event.key==pygame.K_g: tool="fill"
+                if event.key==pygame.K_LEFTBRACKET: brush_size = max(1, brush_size-1)
+                if event.key==pygame.K_RIGHTBRACKET: brush_size = min(MAX_BRUSH, brush_size+1)
+                # Ctrl+Z undo, Ctrl+Y or Ctrl+Shift+Z redo
+                if event.mod & pygame.KMOD_CTRL and not painting and rect_anchor is None:
+                    if event.key==pygame.K_z and not event.mod & pygame.KMOD_SHIFT:
+                        changed(history.undo())
+                    elif event.key in (pygame.K_y, pygame.K_z):
+                        changed(history.redo())
             if event.type==pygame.MOUSEBUTTONDOWN:
                 if event.button == 1:
-                    mx,my = pygame.mouse.get_pos()
-                    gx,gy = (mx+cam_x)//TILESIZE, (my+cam_y)//TILESIZE
-                    if 0 <= gx < MAPW and 0 <= gy < MAPH:
+                    gx,gy = cell_at(event.pos)
+                    if grid.in_bounds(gx, gy):
                         if current_tile == "start":
-                            # Remove previous start
-                            for yy in range(MAPH):
-                                for xx in range(MAPW):
-                                    if grid[yy][xx] == "start":
-                                        grid[yy][xx] = "ice1"
-                            grid[gy][gx] = "start"
+                            place_start(gx, gy)
+                        elif tool == "brush":
+                            history.begin()
+                            paint(brush_cells(grid, gx, gy, brush_size), current_tile)
+                            painting = True
+                            last_cell = (gx, gy)
+                        elif tool == "rect":
+                            rect_anchor = (gx, gy)
                         else:
-                            grid[gy][gx] = current_tile
+                            cells = flood_cells(grid, gx, gy)
+                            if cells is None:
+                                print("Fill area too big!")
+                            else:
+                                history.begin()
+                                paint(cells, current_tile)
+                                history.end()
                 elif event.button == 3:
                     dragging = True
-                    last_mouse = pygame.mouse.get_pos()
+                    last_mouse = event.pos
             if event.type==pygame.MOUSEBUTTONUP:
+                if event.button == 1:
+                    if painting:
+                        history.end()
+                        painting = False
+                    if rect_anchor is not None:
+                        gx,gy = cell_at(event.pos)
+                        history.begin()
+                        paint(rect_cells(grid, *rect_anchor, gx, gy), current_tile)
+                        history.end()
+                        rect_anchor = None
                 if event.button == 3:
                     dragging = False
+            if event.type==pygame.MOUSEMOTION and painting:
+                gx,gy = cell_at(event.pos)
+                paint(line_cells(grid, *last_cell, gx, gy, brush_size), current_tile)
+                last_cell = (gx, gy)
             if event.type==pygame.MOUSEMOTION and dragging:
                 mx,my = event.pos
                 dx,dy = mx-last_mouse[0], my-last_mouse[1]
@@ -157,10 +234,17 @@ def game_loop():
                 cam_y -= dy
                 last_mouse = (mx,my)
 
+        autosave.update()
         draw_grid()
         pygame.display.flip()
         clock.tick(60)
 
+    autosave.close()
+    if autosave.unsaved:
+        # ESC without S: the edits stay in the journal, not in the track file
+        print(f"{autosave.path} has unsaved edits, the game won't use them. They are kept in "
+              f"{autosave.journal} and restored the next time you edit this map (D discards them).")
+
 if __name__ == "__main__":
     game_loop()
     pygame.quit()
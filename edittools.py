@@ -0,0 +1,174 @@
+from array import array
+from collections import deque
+
+UNDO_BYTES = 16 * 1024 * 1024  # memory cap for the undo and redo stacks
+FILL_LIMIT = 1 << 17           # flood fills bigger than this are refused (a whole 480x272 map fits)
+MAX_BRUSH = 15
+
+
+# Cell pickers, all return cell indices (y*width + x) inside the grid
+
+def brush_cells(grid, x, y, size):
+    """Square brush of size x size cells around (x, y)"""
+    x0, y0 = x - (size - 1)//2, y - (size - 1)//2
+    return rect_cells(grid, x0, y0, x0 + size - 1, y0 + size - 1)
+
+
+def line_cells(grid, x0, y0, x1, y1, size):
+    """Brush stamps along a line, so fast drags don't leave gaps"""
+    dx, dy = abs(x1 - x0), abs(y1 - y0)
+    sx, sy = (1 if x1 > x0 else -1), (1 if y1 > y0 else -1)
+    err = dx - dy
+    cells = set()
+    while True:
+        cells.update(brush_cells(grid, x0, y0, size))
+        if x0 == x1 and y0 == y1:
+            return cells
+        e2 = 2*err
+        if e2 > -dy:
+            err -= dy
+            x0 += sx
+        if e2 < dx:
+            err += dx
+            y0 += sy
+
+
+def rect_cells(grid, x0, y0, x1, y1):
+    """Every cell of the rectangle between two corners (inclusive), clipped"""
+    x0, x1 = max(0, min(x0, x1)), min(grid.width - 1, max(x0, x1))
+    y0, y1 = max(0, min(y0, y1)), min(grid.height - 1, max(y0, y1))
+    w = grid.width
+    return [y*w + x for y in range(y0, y1 + 1) for x in range(x0, x1 + 1)]
+
+
+def flood_cells(grid, x, y, limit=FILL_LIMIT):
+    """Cells connected to (x, y) with the same tile, filled a row span at a
+    time. Returns None if the area is bigger than limit."""
+    w, h = grid.width, grid.height
+    cells = grid.cells
+    target = cells[y*w + x]
+    seen = bytearray(w * h)
+    found = []
+    stack = [(x, y)]
+    while stack:
+        x, y = stack.pop()
+        row = y*w
+        if seen[row + x] or cells[row + x] != target:
+            continue
+        left = x
+        while left > 0 and cells[row + left - 1] == target and not seen[row + left - 1]:
+            left -= 1
+        right = x
+        while right < w - 1 and cells[row + right + 1] == target and not seen[row + right + 1]:
+            right += 1
+        seen[row + left:row + right + 1] = b"\x01" * (right - left + 1)
+        found.extend(range(row + left, row + right + 1))
+        if len(found) > limit:
+            return None
+        # Seed the rows above and below once per run of matching cells
+        for ny in (y - 1, y + 1):
+            if not 0 <= ny < h:
+                continue
+            nrow = ny*w
+            inside = False
+            for nx in range(left, right + 1):
+                match = cells[nrow + nx] == target and not seen[nrow + nx]
+                if match and not inside:
+                    stack.append((nx, ny))
+                inside = match
+    return found
+
+
+class Edit:
+    """One undoable operation: changed cell indices and their old/new tile ids"""
+
+    __slots__ = ("indices", "old", "new")
+
+    def __init__(self, indices, old, new):
+        self.indices = indices  # array('I')
+        self.old = old          # bytes, one tile id per index
+        self.new = new
+
+    @property
+    def nbytes(self):
+        return self.indices.itemsize * len(self.indices) + len(self.old) + len(self.new)
+
+
+class EditHistory:
+    """Undo/redo for a TrackGrid.
+
+    Changes go through write() between begin() and end(), so a whole drag,
+    rectangle or fill becomes one Edit. The oldest edits are dropped once
+    the stacks use more than max_bytes.
+    """
+
+    def __init__(self, grid, max_bytes=UNDO_BYTES):
+        self.grid = grid
+        self.max_bytes = max_bytes
+        self.undo_stack = deque()
+        self.redo_stack = []
+        self.used_bytes = 0
+        self.pending = None  # {index: old tile id} for the open operation
+
+    def begin(self):
+        if self.pending is None:
+            self.pending = {}
+
+    def write(self, indices, name):
+        """Set cells to a tile, returns the indices that changed"""
+        grid = self.grid
+        tid = grid.tile_id(name)
+        cells = grid.cells
+        changed = [i for i in indices if cells[i] != tid]
+        if not changed:
+            return changed
+        if self.pending is not None:
+            pending = self.pending
+            for i in changed:
+                if i not in pending:
+                    pending[i] = cells[i]
+        grid.write_cells(changed, bytes([tid]) * len(changed))
+        return changed
+
+    def end(self):
+        pending, self.pending = self.pending, None
+        if not pending:
+            return
+        cells = self.grid.cells
+        indices = array('I', [i for i in pending if cells[i] != pending[i]])
+        if not indices:
+            return
+        edit = Edit(indices, bytes(pending[i] for i in indices), bytes(cells[i] for i in indices))
+        self._push(self.undo_stack, edit)
+        for old in self.redo_stack:
+            self.used_bytes -= old.nbytes
+        self.redo_stack.clear()
+        self._trim()
+
+    def _push(self, stack, edit):
+        stack.append(edit)
+        self.used_bytes += edit.nbytes
+
+    def _trim(self):
+        # Keep at least the newest step, however big
+        while self.used_bytes > self.max_bytes and len(self.undo_stack) > 1:
+            self.used_bytes -= self.undo_stack.popleft().nbytes
+
+    def undo(self):
+        """Revert the last edit, returns its cell indices (empty if nothing to undo)"""
+        self.end()
+        if not self.undo_stack:
+            return ()
+        edit = self.undo_stack.pop()
+        self.grid.write_cells(edit.indices, edit.old)
+        self.redo_stack.append(edit)
+        return edit.indices
+
+    def redo(self):
+        self.end()
+        if not self.redo_stack:
+            return ()
+        edit = self.redo_stack.pop()
+        self.grid.write_cells(edit.indices, edit.new)
+        self.undo_stack.append(edit)
+        return edit.indices
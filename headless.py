@@ -0,0 +1,129 @@
+import random
+import sys
+import time
+from physics import SkaterState, STEP, TILE_SIZE, TURN_LEFT, TURN_RIGHT, ACCELERATE
+from trackfile import load_track
+
+# Input streams are one byte of input bits per physics step, the same as the
+# frames in an input packet
+
+def scripted_inputs(steps, seed=0):
+    """A driver that mostly accelerates and turns in bursts"""
+    rnd = random.Random(seed)
+    out = bytearray()
+    bits = ACCELERATE
+    while len(out) < steps:
+        bits = rnd.choice([ACCELERATE, ACCELERATE, ACCELERATE | TURN_LEFT,
+                           ACCELERATE | TURN_RIGHT, TURN_LEFT, TURN_RIGHT, 0])
+        out.extend([bits] * rnd.randint(5, 60))
+    return bytes(out[:steps])
+
+
+def load_inputs(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def spawn_point(grid, tilesize):
+    start_cell = grid.start
+    if start_cell:
+        x, y = start_cell
+        return (x*tilesize + tilesize//2, y*tilesize + tilesize//2)
+    return (100, 100)
+
+
+def run(grid, inputs, skaters=1, scale=1.0, batch=False):
+    """Race skaters over the track until they all finish or the inputs run
+    out. Skater i plays the stream shifted by i*97 steps so they spread out.
+    Returns the results and timings."""
+    tilesize = int(TILE_SIZE * scale)
+    x, y = spawn_point(grid, tilesize)
+    shifts = [i*97 for i in range(skaters)]
+    finish_step = [None] * skaters
+
+    started = time.perf_counter()
+    if batch:
+        import numpy as np
+        from skaterbatch import SkaterBatch
+        sim = SkaterBatch(skaters, scale)
+        sim.x[:] = x
+        sim.y[:] = y
+        stream = np.frombuffer(inputs, dtype=np.uint8)
+        index = np.array(shifts)
+        running = np.ones(skaters, dtype=bool)
+        steps = 0
+        for t in range(len(inputs)):
+            sim.bits = stream[(index + t) % len(stream)]
+            sim.bits[~running] = 0
+            sim.step()
+            finished = sim.apply_surface_effects(grid) & running
+            steps += int(running.sum())
+            for i in np.flatnonzero(finished):
+                finish_step[i] = t + 1
+            running &= ~finished
+            # Park the finished ones, with no speed and no input they stay put
+            sim.vx[finished] = 0.0
+            sim.vy[finished] = 0.0
+            if not running.any():
+                break
+        crashes = [int(c) for c in sim.crashes]
+    else:
+        sims = [SkaterState(x, y, 0.0, scale) for _ in range(skaters)]
+        running = list(range(skaters))
+        steps = 0
+        for t in range(len(inputs)):
+            still = []
+            for i in running:
+                s = sims[i]
+                s.step(inputs[(shifts[i] + t) % len(inputs)])
+                steps += 1
+                if grid.apply_surface_effects(s, tilesize):
+                    finish_step[i] = t + 1
+                else:
+                    still.append(i)
+            running = still
+            if not running:
+                break
+        crashes = [s.crashes for s in sims]
+    elapsed = time.perf_counter() - started
+
+    return {
+        'skaters': skaters,
+        'steps': steps,
+        'seconds': elapsed,
+        'steps_per_sec': steps / elapsed if elapsed else 0.0,
+        'finish_times': [None if f is None else f * STEP for f in finish_step],
+        'crashes': crashes
+    }
+
+
+if __name__ == "__main__":
+    # python headless.py maps/track1.trk [--inputs file] [--steps N] [--skaters N] [--scale S] [--batch] [--seed N]
+    args = sys.argv[1:]
+    if not args:
+        print("Usage: python headless.py <track> [--inputs file] [--steps N] [--skaters N] "
+              "[--scale S] [--batch] [--seed N]")
+        sys.exit(1)
+
+    def option(name, default):
+        if name in args:
+            return args[args.index(name) + 1]
+        return default
+
+    grid = load_track(args[0])
+    if "--inputs" in args:
+        inputs = load_inputs(option("--inputs", None))
+    else:
+        inputs = scripted_inputs(int(option("--steps", 60*60)), int(option("--seed", 0)))
+    result = run(grid, inputs, int(option("--skaters", 1)), float(option("--scale", 1.0)),
+                 "--batch" in args)
+    grid.close()
+
+    finished = [f for f in result['finish_times'] if f is not None]
+    print(f"{args[0]}: {grid.width}x{grid.height} tiles, {result['skaters']} skaters, "
+          f"{len(inputs)} input steps")
+    print(f"{result['steps']} skater steps in {result['seconds']:.3f}s, "
+          f"{result['steps_per_sec']:.0f} steps/s")
+    if finished:
+        print(f"{len(finished)} finished, best {min(finished):.2f}s")
+    print(f"Crashes: {sum(result['crashes'])}")
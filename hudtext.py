@@ -0,0 +1,78 @@
+from collections import OrderedDict
+
+MAX_TEXTS = 256
+# Pre-rendered for fast-changing numeric fields (timer, speed)
+GLYPHS = "0123456789.:-+s "
+
+
+class GlyphAtlas:
+    """Every glyph of GLYPHS rendered once in one font and colour. Numbers are
+    drawn glyph by glyph, so they never go through the TTF rasterizer again."""
+
+    def __init__(self, font, color, chars=GLYPHS):
+        self.font = font
+        self.color = color
+        self.glyphs = {}  # {char: (surface, advance)}
+        for ch in chars:
+            self._add(ch)
+
+    def _add(self, ch):
+        glyph = (self.font.render(ch, True, self.color), self.font.size(ch)[0])
+        self.glyphs[ch] = glyph
+        return glyph
+
+    def width(self, text):
+        return sum((self.glyphs.get(ch) or self._add(ch))[1] for ch in text)
+
+    def draw(self, surface, text, pos):
+        """Blit text at pos, returns the x where it ends"""
+        x, y = pos
+        glyphs = self.glyphs
+        for ch in text:
+            glyph = glyphs.get(ch) or self._add(ch)
+            surface.blit(glyph[0], (x, y))
+            x += glyph[1]
+        return x
+
+
+class HudText:
+    """Rendered text surfaces cached by (font, text, color), plus a glyph
+    atlas per (font, color) for values that change every frame"""
+
+    def __init__(self, max_entries=MAX_TEXTS):
+        self.max_entries = max_entries
+        self.texts = OrderedDict()
+        self.atlases = {}
+
+    def render(self, font, text, color):
+        key = (font, text, color)
+        surf = self.texts.get(key)
+        if surf is not None:
+            self.texts.move_to_end(key)
+            return surf
+        surf = font.render(text, True, color)
+        self.texts[key] = surf
+        if len(self.texts) > self.max_entries:
+            self.texts.popitem(last=False)
+        return surf
+
+    def atlas(self, font, color):
+        atlas = self.atlases.get((font, color))
+        if atlas is None:
+            atlas = self.atlases[(font, color)] = GlyphAtlas(font, color)
+        return atlas
+
+    def draw(self, surface, font, text, color, pos):
+        """Text that rarely changes (labels, counters)"""
+        surface.blit(self.render(font, text, color), pos)
+
+    def draw_value(self, surface, font, label, value, color, pos):
+        """A cached label followed by a value drawn from the glyph atlas"""
+        label_surf = self.render(font, label, color)
+        surface.blit(label_surf, pos)
+        x = pos[0] + label_surf.get_width()
+        return self.atlas(font, color).draw(surface, value, (x, pos[1]))
+
+
+# Shared by every HUD
+hud_text = HudText()
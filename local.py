@@ -1,15 +1,15 @@
-import pygame, json, sys, math
+import pygame, sys, math
 from local_skater import LocalSkater
-import os
+from physics import FixedStep
+from profiler import FrameProfiler
+from hudtext import hud_text
+from spritecache import rotation_cache
+from chunkcache import ChunkCache
+from trackfile import load_track
+from assets import assets
 import random
 from songfunction import play_random, play_menu_music, stop_music, win, crash
 
-def resource_path(relative_path):
-    # Funziona sia in sviluppo che in build
-    if hasattr(sys, '_MEIPASS'):
-        return os.path.join(sys._MEIPASS, relative_path)
-    return os.path.join(os.path.abspath("."), relative_path)
-
 # Load resolution setting
 def load_resolution():
     try:
@@ -36,29 +36,15 @@ pygame.display.set_caption("Ice Drift - Local Multiplayer")
 clock = pygame.time.Clock()
 
 # Load and scale tiles
-def load_scaled_tile(path):
-    img = pygame.image.load(resource_path(path)).convert_alpha()
-    if SCALE != 1.0:
-        new_size = (int(img.get_width() * SCALE), int(img.get_height() * SCALE))
-        img = pygame.transform.scale(img, new_size)
-    return img
-
-tiles = {
-    "ice1": load_scaled_tile("assets/images/roadstuff/ice1.png"),
-    "ice2": load_scaled_tile("assets/images/roadstuff/ice2.png"),
-    "ice3": load_scaled_tile("assets/images/roadstuff/ice3.png"),
-    "snow1": load_scaled_tile("assets/images/roadstuff/snow1.png"),
-    "snow2": load_scaled_tile("assets/images/roadstuff/snow2.png"),
-    "snow3": load_scaled_tile("assets/images/roadstuff/snow3.png"),
-    "cono": load_scaled_tile("assets/images/roadstuff/cono.png"),
-    "start": load_scaled_tile("assets/images/roadstuff/start.png"),
-    "finish": load_scaled_tile("assets/images/roadstuff/finish.png"),
-}
+tiles = assets.tiles(SCALE)
 
 # HUD fonts
 font_size = int(18 * SCALE)
 font = pygame.font.SysFont("consolas", font_size)
 
+# Frame timings, F3 toggles the overlay and F4 writes a trace
+profiler = FrameProfiler(SCALE)
+
 def game_loop():
     play_random()
     # Load map
@@ -66,22 +52,18 @@ def game_loop():
         with open("selected.txt", "r") as f:
             selected_map = f.readline().strip()
     except:
-        selected_map = "track1.json"
+        selected_map = "track1.trk"
     
-    with open("maps/" + selected_map) as f:
-        grid = json.load(f)
+    grid = load_track("maps/" + selected_map)
 
-    MAPW, MAPH = len(grid[0]), len(grid)
+    MAPW, MAPH = grid.width, grid.height
 
     # Find start position
     start_pos = None
-    for y in range(MAPH):
-        for x in range(MAPW):
-            if grid[y][x] == "start":
-                start_pos = (x*TILESIZE + TILESIZE//2, y*TILESIZE + TILESIZE//2)
-                break
-        if start_pos:
-            break
+    start_cell = grid.start
+    if start_cell:
+        x, y = start_cell
+        start_pos = (x*TILESIZE + TILESIZE//2, y*TILESIZE + TILESIZE//2)
 
     if not start_pos:
         start_pos = (100, 100)
@@ -92,82 +74,48 @@ def game_loop():
     # Player 2: Arrow keys, spawn slightly offset
     player2_spawn = (start_pos[0] + int(50*SCALE), start_pos[1])
     player2 = LocalSkater(player2_spawn, SCALE, control_scheme='arrows')
+    # Rotate the sprites now rather than during the first frames of the race
+    rotation_cache.warm(player1.idle_frames + player1.sprint_frames)
 
     # Split screen dimensions
     split_width = WIDTH // 2
     split_height = HEIGHT
 
-    def draw_map(surface, cam_x, cam_y, view_width, view_height):
-        start_x = max(0, cam_x//TILESIZE)
-        start_y = max(0, cam_y//TILESIZE)
-        end_x = min(MAPW, (cam_x+view_width)//TILESIZE+2)
-        end_y = min(MAPH, (cam_y+view_height)//TILESIZE+2)
-
-        for y in range(start_y, end_y):
-            for x in range(start_x, end_x):
-                tile = grid[y][x]
-                draw_x = x*TILESIZE - cam_x
-                draw_y = y*TILESIZE - cam_y
-                surface.blit(tiles[tile], (draw_x, draw_y))
+    # Both views share one chunk cache
+    chunk_cache = ChunkCache(grid, tiles, TILESIZE)
 
-    def apply_surface_effects(player):
-        gx, gy = int(player.pos.x//TILESIZE), int(player.pos.y//TILESIZE)
-        if 0 <= gy < MAPH and 0 <= gx < MAPW:
-            tile = grid[gy][gx]
-            if "snow" in tile:
-                player.vx *= 0.95
-                player.vy *= 0.95
-            elif "ice" in tile:
-                player.vx *= 1.02
-                player.vy *= 1.02
-            elif "cono" in tile:
-                cone_rect = pygame.Rect(gx*TILESIZE, gy*TILESIZE, TILESIZE, TILESIZE)
-                if player.rect.colliderect(cone_rect):
-                    player.vx *= -0.4
-                    player.vy *= -0.4
-                    if player.rect.centerx < cone_rect.centerx:
-                        player.pos.x = cone_rect.left - player.rect.width//2
-                    else:
-                        player.pos.x = cone_rect.right + player.rect.width//2
-                    if player.rect.centery < cone_rect.centery:
-                        player.pos.y = cone_rect.top - player.rect.height//2
-                    else:
-                        player.pos.y = cone_rect.bottom + player.rect.height//2
-                    player.rect.center = player.pos
-                    player.crashes += 1
-                    crash()
-            elif "finish" in tile and not player.finished:
-                return True
-        return False
+    def draw_map(surface, cam_x, cam_y, view_width, view_height):
+        chunk_cache.draw(surface, cam_x, cam_y, view_width, view_height)
 
     def draw_hud(surface, player, x_offset, y_offset, player_num, time_sec):
         t_ms = int(time_sec*1000)
         
         # Player label
-        label = font.render(f"P{player_num}", True, (255, 255, 100))
-        surface.blit(label, (x_offset + int(10*SCALE), y_offset + int(10*SCALE)))
+        hud_text.draw(surface, font, f"P{player_num}", (255, 255, 100),
+                      (x_offset + int(10*SCALE), y_offset + int(10*SCALE)))
         
         # Time
+        time_pos = (x_offset + int(10*SCALE), y_offset + int(35*SCALE))
         if not player.finished:
-            text = font.render(f"Time: {t_ms//1000}.{t_ms%1000:03d}s", True, (230,230,255))
+            hud_text.draw_value(surface, font, "Time: ", f"{t_ms//1000}.{t_ms%1000:03d}s", (230,230,255), time_pos)
         else:
+            # Final time doesn't change any more, cache the whole line
             final_ms = int(player.finish_time*1000)
-            text = font.render(f"Time: {final_ms//1000}.{final_ms%1000:03d}s", True, (100,255,100))
-        surface.blit(text, (x_offset + int(10*SCALE), y_offset + int(35*SCALE)))
+            hud_text.draw(surface, font, f"Time: {final_ms//1000}.{final_ms%1000:03d}s", (100,255,100), time_pos)
         
         # Speed
         speed = math.hypot(player.vx, player.vy)
-        v_text = font.render(f"Vel: {speed:05.2f}", True, (230,230,255))
-        surface.blit(v_text, (x_offset + int(10*SCALE), y_offset + int(60*SCALE)))
+        hud_text.draw_value(surface, font, "Vel: ", f"{speed:05.2f}", (230,230,255),
+                            (x_offset + int(10*SCALE), y_offset + int(60*SCALE)))
         
         # Crashes
-        c_text = font.render(f"Crash: {player.crashes}", True, (230,230,255))
-        surface.blit(c_text, (x_offset + int(10*SCALE), y_offset + int(85*SCALE)))
+        hud_text.draw(surface, font, f"Crash: {player.crashes}", (230,230,255),
+                      (x_offset + int(10*SCALE), y_offset + int(85*SCALE)))
         
         # Finished indicator
         if player.finished:
-            finished_text = font.render("FINISHED!", True, (100,255,100))
-            surface.blit(finished_text, (x_offset + int(10*SCALE), y_offset + int(110*SCALE)))
+            hud_text.draw(surface, font, "FINISHED!", (100,255,100),
+                          (x_offset + int(10*SCALE), y_offset + int(110*SCALE)))
 
     def show_stats(p1_time, p1_crashes, p2_time, p2_crashes):
         win()
@@ -224,10 +172,13 @@ def game_loop():
     running = True
     race_time = 0.0
     first = True
+    stepper = FixedStep()
 
     
     while running:
+        profiler.begin_frame()
         dt = clock.tick(FPS)/1000
+        profiler.mark("wait")
         
         for e in pygame.event.get():
             if e.type == pygame.QUIT:
@@ -239,23 +190,29 @@ def game_loop():
                 if e.key == pygame.K_ESCAPE:
                     play_menu_music()
                     running = False
+            profiler.handle_event(e)
+        profiler.mark("events")
 
         keys = pygame.key.get_pressed()
         
-        # Update players
-        player1.update(keys, dt)
-        player2.update(keys, dt)
-
-        
-        
-        # Apply surface effects
-        if apply_surface_effects(player1) and not player1.finished:
-            player1.finished = True
-            player1.finish_time = race_time
-        
-        if apply_surface_effects(player2) and not player2.finished:
-            player2.finished = True
-            player2.finish_time = race_time
+        # Update players in fixed physics steps
+        for _ in range(stepper.advance(dt)):
+            player1.update(keys)
+            player2.update(keys)
+            profiler.mark("update")
+
+            # Apply surface effects
+            if grid.apply_surface_effects(player1, TILESIZE, crash) and not player1.finished:
+                player1.finished = True
+                player1.finish_time = race_time
+            
+            if grid.apply_surface_effects(player2, TILESIZE, crash) and not player2.finished:
+                player2.finished = True
+                player2.finish_time = race_time
+            profiler.mark("surface")
+        alpha = stepper.alpha
+        view1_x, view1_y = player1.lerp(alpha)
+        view2_x, view2_y = player2.lerp(alpha)
 
         race_time += dt
 
@@ -269,29 +226,35 @@ def game_loop():
             continue
 
         # Calculate cameras
-        cam1_x = int(player1.pos.x - split_width//2)
-        cam1_y = int(player1.pos.y - split_height//2)
+        cam1_x = int(view1_x - split_width//2)
+        cam1_y = int(view1_y - split_height//2)
         cam1_x = max(0, min(cam1_x, MAPW*TILESIZE - split_width))
         cam1_y = max(0, min(cam1_y, MAPH*TILESIZE - split_height))
 
-        cam2_x = int(player2.pos.x - split_width//2)
-        cam2_y = int(player2.pos.y - split_height//2)
+        cam2_x = int(view2_x - split_width//2)
+        cam2_y = int(view2_y - split_height//2)
         cam2_x = max(0, min(cam2_x, MAPW*TILESIZE - split_width))
         cam2_y = max(0, min(cam2_y, MAPH*TILESIZE - split_height))
 
         # Draw left screen (Player 1)
         left_surface.fill((30,40,55))
         draw_map(left_surface, cam1_x, cam1_y, split_width, split_height)
-        player1.draw(left_surface, cam1_x, cam1_y)
-        player2.draw(left_surface, cam1_x, cam1_y)  # Draw other player too
+        profiler.mark("map")
+        player1.draw(left_surface, cam1_x, cam1_y, alpha)
+        player2.draw(left_surface, cam1_x, cam1_y, alpha)  # Draw other player too
+        profiler.mark("skaters")
         draw_hud(left_surface, player1, 0, 0, 1, race_time)
+        profiler.mark("hud")
 
         # Draw right screen (Player 2)
         right_surface.fill((30,40,55))
         draw_map(right_surface, cam2_x, cam2_y, split_width, split_height)
-        player1.draw(right_surface, cam2_x, cam2_y)  # Draw other player too
-        player2.draw(right_surface, cam2_x, cam2_y)
+        profiler.mark("map")
+        player1.draw(right_surface, cam2_x, cam2_y, alpha)  # Draw other player too
+        player2.draw(right_surface, cam2_x, cam2_y, alpha)
+        profiler.mark("skaters")
         draw_hud(right_surface, player2, 0, 0, 2, race_time)
+        profiler.mark("hud")
 
         # Combine to main screen
         screen.blit(left_surface, (0, 0))
@@ -299,8 +262,14 @@ def game_loop():
         
         # Draw divider line
         pygame.draw.line(screen, (100, 100, 100), (split_width, 0), (split_width, HEIGHT), 3)
+        profiler.mark("compose")
+        profiler.draw(screen)
+        profiler.mark("overlay")
 
         pygame.display.flip()
+        profiler.mark("flip")
+        profiler.end_frame()
+    grid.close()
 
 if __name__ == "__main__":
     game_loop()
@@ -1,60 +1,43 @@
-import pygame, os
+import pygame
 from pygame.math import Vector2
-import math
-import os, sys
+from spritecache import rotation_cache
+from assets import assets
+from physics import SkaterState, TURN_LEFT, TURN_RIGHT, ACCELERATE, STEP
 # t
-def resource_path(relative_path):
-    # Funziona sia in sviluppo che in build
-    if hasattr(sys, '_MEIPASS'):
-        return os.path.join(sys._MEIPASS, relative_path)
-    return os.path.join(os.path.abspath("."), relative_path)
-
-
-def load_frames(path, scale=1.0):
-    frames = []
-    for fname in sorted(os.listdir(path)):
-        if fname.endswith(".png"):
-            img = pygame.image.load(resource_path(os.path.join(path, fname))).convert_alpha()
-            if scale != 1.0:
-                new_size = (int(img.get_width() * scale), int(img.get_height() * scale))
-                img = pygame.transform.scale(img, new_size)
-            frames.append(img)
-    return frames
-
-class LocalSkater:
+class LocalSkater(SkaterState):
     def __init__(self, spawn_point, scale=1.0, control_scheme='wasd'):
         """
         control_scheme: 'wasd' or 'arrows'
         """
-        self.scale = scale
+        super().__init__(spawn_point[0], spawn_point[1], 0.0, scale)
         self.control_scheme = control_scheme
         
-        self.idle_frames = load_frames("assets/images/thing/idle", scale)
-        self.sprint_frames = load_frames("assets/images/thing/sprint", scale)
+        self.idle_frames = assets.frames("assets/images/thing/idle", scale)
+        self.sprint_frames = assets.frames("assets/images/thing/sprint", scale)
         self.current_frames = self.idle_frames
         self.frame_index = 0
         self.frame_timer = 0.0
         self.frame_speed = 0.15
 
-        self.pos = Vector2(spawn_point)
-        self.vx = 0.0
-        self.vy = 0.0
-        self.angle = 0.0
-        self.rect = self.idle_frames[0].get_rect(center=spawn_point)
-
-        # Scale physics parameters
-        self.accel = 90 * scale
-        self.max_speed = 300 * scale
-        self.turn_rate = 200
-        self.friction = 0.98
-
-        self.crashes = 0
         self.finished = False
         self.finish_time = 0.0
 
-    def update(self, keys, dt):
+    @property
+    def pos(self):
+        return Vector2(self.x, self.y)
+
+    @pos.setter
+    def pos(self, value):
+        self.x, self.y = value
+
+    @property
+    def rect(self):
+        return self.idle_frames[0].get_rect(center=(self.x, self.y))
+
+    def update(self, keys, dt=STEP):
         # Don't update if finished
         if self.finished:
+            self.prev_x, self.prev_y = self.x, self.y
             return
         
         # Different control schemes
@@ -67,32 +50,14 @@ class LocalSkater:
             turn_right = keys[pygame.K_RIGHT]
             accelerate = keys[pygame.K_UP]
         
+        bits = 0
         if turn_left:
-            self.angle -= self.turn_rate * dt
+            bits |= TURN_LEFT
         if turn_right:
-            self.angle += self.turn_rate * dt
-
-        forward = Vector2(
-            math.cos(math.radians(self.angle - 90)),
-            math.sin(math.radians(self.angle - 90))
-        )
-
+            bits |= TURN_RIGHT
         if accelerate:
-            self.vx += forward.x * self.accel * dt
-            self.vy += forward.y * self.accel * dt
-
-        self.vx *= self.friction
-        self.vy *= self.friction
-
-        speed = math.hypot(self.vx, self.vy)
-        if speed > self.max_speed:
-            scale_factor = self.max_speed / speed
-            self.vx *= scale_factor
-            self.vy *= scale_factor
-
-        self.pos.x += self.vx * dt
-        self.pos.y += self.vy * dt
-        self.rect.center = self.pos
+            bits |= ACCELERATE
+        speed = self.step(bits, dt)
 
         # Animation threshold scaled
         if speed > 20 * self.scale:
@@ -105,9 +70,11 @@ class LocalSkater:
             self.frame_timer = 0
             self.frame_index = (self.frame_index + 1) % len(self.current_frames)
 
-    def draw(self, surface, cam_x, cam_y):
+    def draw(self, surface, cam_x, cam_y, alpha=1.0):
+        """alpha: how far between the last two physics steps to draw it"""
+        x, y = self.lerp(alpha)
         frame = self.current_frames[self.frame_index]
-        rotated = pygame.transform.rotate(frame, -(self.angle))
-        rect = rotated.get_rect(center=(self.rect.centerx - cam_x,
-                                        self.rect.centery - cam_y))
+        rotated = rotation_cache.get(frame, -(self.angle))
+        rect = rotated.get_rect(center=(x - cam_x,
+                                        y - cam_y))
         surface.blit(rotated, rect)
\ No newline at end of file
@@ -1,14 +1,15 @@
-import pygame, json, sys, math
-from skater import Skater
-import os
+import pygame, sys, math
+from skater import Skater, input_bits
+from physics import FixedStep
+from profiler import FrameProfiler
+from hudtext import hud_text
+from spritecache import rotation_cache
+from chunkcache import ChunkCache
+from trackfile import load_track
+from assets import assets
 import random
 from songfunction import play_random, play_menu_music, stop_music, win, crash
 
-def resource_path(relative_path):
-    # Funziona sia in sviluppo che in build
-    if hasattr(sys, '_MEIPASS'):
-        return os.path.join(sys._MEIPASS, relative_path)
-    return os.path.join(os.path.abspath("."), relative_path)
 # Load resolution setting
 def load_resolution():
     try:
@@ -35,62 +36,47 @@ pygame.display.set_caption("Ice Drift")
 clock = pygame.time.Clock()
 
 # Load and scale tiles
-def load_scaled_tile(path):
-    img = pygame.image.load(resource_path(path)).convert_alpha()
-    if SCALE != 1.0:
-        new_size = (int(img.get_width() * SCALE), int(img.get_height() * SCALE))
-        img = pygame.transform.scale(img, new_size)
-    return img
-
-tiles = {
-    "ice1": load_scaled_tile("assets/images/roadstuff/ice1.png"),
-    "ice2": load_scaled_tile("assets/images/roadstuff/ice2.png"),
-    "ice3": load_scaled_tile("assets/images/roadstuff/ice3.png"),
-    "snow1": load_scaled_tile("assets/images/roadstuff/snow1.png"),
-    "snow2": load_scaled_tile("assets/images/roadstuff/snow2.png"),
-    "snow3": load_scaled_tile("assets/images/roadstuff/snow3.png"),
-    "cono": load_scaled_tile("assets/images/roadstuff/cono.png"),
-    "start": load_scaled_tile("assets/images/roadstuff/start.png"),
-    "finish": load_scaled_tile("assets/images/roadstuff/finish.png"),
-}
+tiles = assets.tiles(SCALE)
 
 # HUD fonts
 font_size = int(22 * SCALE)
 font = pygame.font.SysFont("consolas", font_size)
 
+# Frame timings, F3 toggles the overlay and F4 writes a trace
+profiler = FrameProfiler(SCALE)
 
 
 
 
-def game_loop():
+
+def game_loop(record=None):
+    """record: file to save the input of every physics step to, for headless.py"""
     play_random()
     # Load map INSIDE game_loop so it reads the correct selected.txt
     try:
         with open("selected.txt", "r") as f:
             selected_map = f.readline().strip()
     except:
-        selected_map = "track1.json"
+        selected_map = "track1.trk"
     
-    with open("maps/" + selected_map) as f:
-        grid = json.load(f)
+    grid = load_track("maps/" + selected_map)
 
-    MAPW, MAPH = len(grid[0]), len(grid)
+    MAPW, MAPH = grid.width, grid.height
 
     # Find start position
     start_pos = None
-    for y in range(MAPH):
-        for x in range(MAPW):
-            if grid[y][x] == "start":
-                start_pos = (x*TILESIZE + TILESIZE//2, y*TILESIZE + TILESIZE//2)
-                break
-        if start_pos:
-            break
+    start_cell = grid.start
+    if start_cell:
+        x, y = start_cell
+        start_pos = (x*TILESIZE + TILESIZE//2, y*TILESIZE + TILESIZE//2)
 
     if not start_pos:
         start_pos = (100, 100)
 
     # Player
     skater = Skater(start_pos, SCALE)
+    # Rotate the sprites now rather than during the first frames of the race
+    rotation_cache.warm(skater.idle_frames + skater.sprint_frames)
 
 
     race_time = 0.0
@@ -98,58 +84,21 @@ def game_loop():
     finished = False
     running = True
 
+    # Map is baked into chunks once and drawn with a handful of blits
+    chunk_cache = ChunkCache(grid, tiles, TILESIZE)
+
     def draw_map(cam_x, cam_y):
-        start_x = max(0, cam_x//TILESIZE)
-        start_y = max(0, cam_y//TILESIZE)
-        end_x = min(MAPW, (cam_x+WIDTH)//TILESIZE+2)
-        end_y = min(MAPH, (cam_y+HEIGHT)//TILESIZE+2)
-
-        for y in range(start_y, end_y):
-            for x in range(start_x, end_x):
-                tile = grid[y][x]
-                draw_x = x*TILESIZE - cam_x
-                draw_y = y*TILESIZE - cam_y
-                screen.blit(tiles[tile], (draw_x, draw_y))
-
-    def apply_surface_effects():
-        gx, gy = int(skater.pos.x//TILESIZE), int(skater.pos.y//TILESIZE)
-        if 0 <= gy < MAPH and 0 <= gx < MAPW:
-            tile = grid[gy][gx]
-            if "snow" in tile:
-                skater.vx *= 0.95
-                skater.vy *= 0.95
-            elif "ice" in tile:
-                skater.vx *= 1.02
-                skater.vy *= 1.02
-            elif "cono" in tile:
-                cone_rect = pygame.Rect(gx*TILESIZE, gy*TILESIZE, TILESIZE, TILESIZE)
-                if skater.rect.colliderect(cone_rect):
-                    skater.vx *= -0.4
-                    skater.vy *= -0.4
-                    if skater.rect.centerx < cone_rect.centerx:
-                        skater.pos.x = cone_rect.left - skater.rect.width//2
-                    else:
-                        skater.pos.x = cone_rect.right + skater.rect.width//2
-                    if skater.rect.centery < cone_rect.centery:
-                        skater.pos.y = cone_rect.top - skater.rect.height//2
-                    else:
-                        skater.pos.y = cone_rect.bottom + skater.rect.height//2
-                    skater.rect.center = skater.pos
-                    skater.crashes += 1
-                    crash()
-            elif "finish" in tile:
-                return True
-        return False
+        chunk_cache.draw(screen, cam_x, cam_y, WIDTH, HEIGHT)
 
     def draw_hud(time_sec):
         t_ms = int(time_sec*1000)
-        text = font.render(f"Time: {t_ms//1000}.{t_ms%1000:03d}s", True, (230,230,255))
-        screen.blit(text, (int(20*SCALE), int(20*SCALE)))
+        hud_text.draw_value(screen, font, "Time: ", f"{t_ms//1000}.{t_ms%1000:03d}s", (230,230,255),
+                            (int(20*SCALE), int(20*SCALE)))
         speed = math.hypot(skater.vx, skater.vy)
-        v_text = font.render(f"Vel: {speed:05.2f}", True, (230,230,255))
-        screen.blit(v_text, (int(20*SCALE), int(50*SCALE)))
-        c_text = font.render(f"Crash: {skater.crashes}", True, (230,230,255))
-        screen.blit(c_text, (int(20*SCALE), int(80*SCALE)))
+        hud_text.draw_value(screen, font, "Vel: ", f"{speed:05.2f}", (230,230,255),
+                            (int(20*SCALE), int(50*SCALE)))
+        hud_text.draw(screen, font, f"Crash: {skater.crashes}", (230,230,255),
+                      (int(20*SCALE), int(80*SCALE)))
 
     def show_stats(final_time, crashes):
         win()
@@ -175,8 +124,12 @@ def game_loop():
     race_time=0.0
     finished=False
     first=True
+    stepper = FixedStep()
+    recording = bytearray() if record else None
     while running and not finished:
+        profiler.begin_frame()
         dt = clock.tick(FPS)/1000
+        profiler.mark("wait")
         for e in pygame.event.get():
             if e.type==pygame.QUIT:
                 running=False
@@ -184,27 +137,50 @@ def game_loop():
                 if e.key==pygame.K_ESCAPE:
                     play_menu_music()
                     running=False
+            profiler.handle_event(e)
+        profiler.mark("events")
 
         keys = pygame.key.get_pressed()
-        skater.update(keys, dt)
-        if apply_surface_effects():
-            finished=True
+        bits = input_bits(keys)
+        # Fixed physics steps, however long the frame took
+        for _ in range(stepper.advance(dt)):
+            if recording is not None:
+                recording.append(bits)
+            skater.apply_input(bits)
+            profiler.mark("update")
+            finished = grid.apply_surface_effects(skater, TILESIZE, crash)
+            profiler.mark("surface")
+            if finished:
+                break
+        view_x, view_y = skater.lerp(stepper.alpha)
 
         race_time += dt
         if first:
             first=False
             race_time=0.0
 
-        cam_x = int(skater.pos.x - WIDTH//2)
-        cam_y = int(skater.pos.y - HEIGHT//2)
+        cam_x = int(view_x - WIDTH//2)
+        cam_y = int(view_y - HEIGHT//2)
         cam_x = max(0, min(cam_x, MAPW*TILESIZE - WIDTH))
         cam_y = max(0, min(cam_y, MAPH*TILESIZE - HEIGHT))
 
         screen.fill((30,40,55))
         draw_map(cam_x, cam_y)
-        skater.draw(screen, cam_x, cam_y)
+        profiler.mark("map")
+        skater.draw(screen, cam_x, cam_y, stepper.alpha)
+        profiler.mark("skaters")
         draw_hud(race_time)
+        profiler.mark("hud")
+        profiler.draw(screen)
+        profiler.mark("overlay")
         pygame.display.flip()
+        profiler.mark("flip")
+        profiler.end_frame()
+    grid.close()
+
+    if record:
+        with open(record, "wb") as f:
+            f.write(recording)
 
     # Show final stats
     if finished:
@@ -1,15 +1,15 @@
-import pygame, json, sys, math
-from skater import Skater
+import pygame, sys, math
+from skater import Skater, input_bits
+from physics import FixedStep
+from profiler import FrameProfiler
+from hudtext import hud_text
+from spritecache import rotation_cache
 from client import GameClient
-import os
+from chunkcache import ChunkCache
+from trackfile import load_track
+from assets import assets
 from songfunction import play_random, play_menu_music, stop_music, win, crash
 
-def resource_path(relative_path):
-    # Funziona sia in sviluppo che in build
-    if hasattr(sys, '_MEIPASS'):
-        return os.path.join(sys._MEIPASS, relative_path)
-    return os.path.join(os.path.abspath("."), relative_path)
-
 # Load resolution setting
 def load_resolution():
     try:
@@ -36,29 +36,15 @@ pygame.display.set_caption("Ice Drift - Multiplayer")
 clock = pygame.time.Clock()
 
 # Load and scale tiles
-def load_scaled_tile(path):
-    img = pygame.image.load(resource_path(path)).convert_alpha()
-    if SCALE != 1.0:
-        new_size = (int(img.get_width() * SCALE), int(img.get_height() * SCALE))
-        img = pygame.transform.scale(img, new_size)
-    return img
-
-tiles = {
-    "ice1": load_scaled_tile("assets/images/roadstuff/ice1.png"),
-    "ice2": load_scaled_tile("assets/images/roadstuff/ice2.png"),
-    "ice3": load_scaled_tile("assets/images/roadstuff/ice3.png"),
-    "snow1": load_scaled_tile("assets/images/roadstuff/snow1.png"),
-    "snow2": load_scaled_tile("assets/images/roadstuff/snow2.png"),
-    "snow3": load_scaled_tile("assets/images/roadstuff/snow3.png"),
-    "cono": load_scaled_tile("assets/images/roadstuff/cono.png"),
-    "start": load_scaled_tile("assets/images/roadstuff/start.png"),
-    "finish": load_scaled_tile("assets/images/roadstuff/finish.png"),
-}
+tiles = assets.tiles(SCALE)
 
 # HUD fonts
 font_size = int(22 * SCALE)
 font = pygame.font.SysFont("consolas", font_size)
 
+# Frame timings, F3 toggles the overlay and F4 writes a trace
+profiler = FrameProfiler(SCALE)
+
 def game_loop(multiplayer=False, server_ip='rke2.fsmn.xyz:5555'):
     # Initialize network client if multiplayer
     play_random()
@@ -71,94 +57,62 @@ def game_loop(multiplayer=False, server_ip='rke2.fsmn.xyz:5555'):
         with open("selected.txt", "r") as f:
             selected_map = f.readline().strip()
     except:
-        selected_map = "track1.json"
+        selected_map = "track1.trk"
     
-    with open("maps/" + selected_map) as f:
-        grid = json.load(f)
+    grid = load_track("maps/" + selected_map)
 
-    MAPW, MAPH = len(grid[0]), len(grid)
+    MAPW, MAPH = grid.width, grid.height
 
     # Find start position
     start_pos = None
-    for y in range(MAPH):
-        for x in range(MAPW):
-            if grid[y][x] == "start":
-                start_pos = (x*TILESIZE + TILESIZE//2, y*TILESIZE + TILESIZE//2)
-                break
-        if start_pos:
-            break
+    start_cell = grid.start
+    if start_cell:
+        x, y = start_cell
+        start_pos = (x*TILESIZE + TILESIZE//2, y*TILESIZE + TILESIZE//2)
 
     if not start_pos:
         start_pos = (100, 100)
 
     # Player
     skater = Skater(start_pos, SCALE)
+    # Rotate the sprites now rather than during the first frames of the race
+    rotation_cache.warm(skater.idle_frames + skater.sprint_frames)
     
     # Connect to server if multiplayer
     if multiplayer:
         print("Connecting to server...")
-        if not client.connect(skater.pos.x, skater.pos.y, skater.angle):
+        if not client.connect(skater.x, skater.y, skater.angle, selected_map, SCALE):
             print("Failed to connect to server!")
+            grid.close()
             return
         print("Connected successfully!")
     
     # Other players (multiplayer only)
     other_skaters = {}  # {player_id: Skater}
+    remote_version = 0  # RemoteState the skaters were last rebuilt from
 
-    def draw_map(cam_x, cam_y):
-        start_x = max(0, cam_x//TILESIZE)
-        start_y = max(0, cam_y//TILESIZE)
-        end_x = min(MAPW, (cam_x+WIDTH)//TILESIZE+2)
-        end_y = min(MAPH, (cam_y+HEIGHT)//TILESIZE+2)
+    # Map is baked into chunks once and drawn with a handful of blits
+    chunk_cache = ChunkCache(grid, tiles, TILESIZE)
 
-        for y in range(start_y, end_y):
-            for x in range(start_x, end_x):
-                tile = grid[y][x]
-                draw_x = x*TILESIZE - cam_x
-                draw_y = y*TILESIZE - cam_y
-                screen.blit(tiles[tile], (draw_x, draw_y))
+    def simulate(s, bits):
+        """One physics step, as the server runs it"""
+        s.step(bits)
+        grid.apply_surface_effects(s, TILESIZE)
 
-    def apply_surface_effects():
-        gx, gy = int(skater.pos.x//TILESIZE), int(skater.pos.y//TILESIZE)
-        if 0 <= gy < MAPH and 0 <= gx < MAPW:
-            tile = grid[gy][gx]
-            if "snow" in tile:
-                skater.vx *= 0.95
-                skater.vy *= 0.95
-            elif "ice" in tile:
-                skater.vx *= 1.02
-                skater.vy *= 1.02
-            elif "cono" in tile:
-                cone_rect = pygame.Rect(gx*TILESIZE, gy*TILESIZE, TILESIZE, TILESIZE)
-                if skater.rect.colliderect(cone_rect):
-                    skater.vx *= -0.4
-                    skater.vy *= -0.4
-                    if skater.rect.centerx < cone_rect.centerx:
-                        skater.pos.x = cone_rect.left - skater.rect.width//2
-                    else:
-                        skater.pos.x = cone_rect.right + skater.rect.width//2
-                    if skater.rect.centery < cone_rect.centery:
-                        skater.pos.y = cone_rect.top - skater.rect.height//2
-                    else:
-                        skater.pos.y = cone_rect.bottom + skater.rect.height//2
-                    skater.rect.center = skater.pos
-                    skater.crashes += 1
-                    crash()
-            elif "finish" in tile:
-                return True
-        return False
+    def draw_map(cam_x, cam_y):
+        chunk_cache.draw(screen, cam_x, cam_y, WIDTH, HEIGHT)
 
     def draw_hud(time_sec):
         speed = math.hypot(skater.vx, skater.vy)
-        v_text = font.render(f"Vel: {speed:05.2f}", True, (230,230,255))
-        screen.blit(v_text, (int(20*SCALE), int(50*SCALE)))
-        c_text = font.render(f"Crash: {skater.crashes}", True, (230,230,255))
-        screen.blit(c_text, (int(20*SCALE), int(80*SCALE)))
+        hud_text.draw_value(screen, font, "Vel: ", f"{speed:05.2f}", (230,230,255),
+                            (int(20*SCALE), int(50*SCALE)))
+        hud_text.draw(screen, font, f"Crash: {skater.crashes}", (230,230,255),
+                      (int(20*SCALE), int(80*SCALE)))
         
         if multiplayer and client:
             player_count = len(client.get_other_players()) + 1
-            p_text = font.render(f"Players: {player_count}", True, (230,230,255))
-            screen.blit(p_text, (int(20*SCALE), int(110*SCALE)))
+            hud_text.draw(screen, font, f"Players: {player_count}", (230,230,255),
+                          (int(20*SCALE), int(110*SCALE)))
 
     def show_stats(final_time, crashes):
         win()
@@ -181,9 +135,12 @@ def game_loop(multiplayer=False, server_ip='rke2.fsmn.xyz:5555'):
     race_time=0.0
     finished=False
     update_counter = 0
+    stepper = FixedStep()
     
     while running and not finished:
+        profiler.begin_frame()
         dt = clock.tick(FPS)/1000
+        profiler.mark("wait")
         for e in pygame.event.get():
             if e.type==pygame.QUIT:
                 running=False
@@ -191,62 +148,78 @@ def game_loop(multiplayer=False, server_ip='rke2.fsmn.xyz:5555'):
                 if e.key==pygame.K_ESCAPE:
                     play_menu_music()
                     running=False
+            profiler.handle_event(e)
+        profiler.mark("events")
 
         keys = pygame.key.get_pressed()
-        skater.update(keys, dt)
-        if apply_surface_effects():
-            finished=True
+        bits = input_bits(keys)
+        input_mode = multiplayer and client and client.input_mode
+        if input_mode:
+            # Predict from our own input, the server runs the same steps and
+            # we replay the ones it hasn't confirmed when its state arrives
+            client.reconcile(skater, simulate)
+            profiler.mark("reconcile")
+        # Fixed physics steps, however long the frame took
+        for _ in range(stepper.advance(dt)):
+            if input_mode and not client.add_input(bits):
+                break  # Too far ahead of the server, wait for it to catch up
+            skater.apply_input(bits)
+            profiler.mark("update")
+            finished = grid.apply_surface_effects(skater, TILESIZE, crash)
+            profiler.mark("surface")
+            if finished:
+                break
+        view_x, view_y = skater.lerp(stepper.alpha)
 
         # Send updates to server (every 2 frames for efficiency)
         if multiplayer and client:
             update_counter += 1
             if update_counter >= 2:
-                client.send_update(skater.pos.x, skater.pos.y, skater.angle, 
-                                 skater.vx, skater.vy, skater.crashes)
+                if client.input_mode:
+                    client.send_inputs()
+                else:
+                    client.send_update(skater.x, skater.y, skater.angle,
+                                     skater.vx, skater.vy, skater.crashes)
                 update_counter = 0
             
             # Update other players
-            other_players_data = client.get_other_players()
-            
-            # Remove players who disconnected
-            for pid in list(other_skaters.keys()):
-                if pid not in other_players_data:
-                    del other_skaters[pid]
+            remote = client.get_remote()
+            if remote.version != remote_version:
+                # New state from the server, add and remove skaters
+                remote_version = remote.version
+                for pid in list(other_skaters.keys()):
+                    if pid not in remote.players:
+                        del other_skaters[pid]
+                for pid, data in remote.players.items():
+                    if pid not in other_skaters:
+                        # Create new player at their current position
+                        other_skaters[pid] = Skater((data['x'], data['y']), SCALE)
             
-            # Update/create other players
+            # Remote players are drawn slightly in the past, interpolated
+            # between snapshots so they move smoothly at any frame rate
+            other_players_data = client.get_interpolated_players(remote=remote)
             for pid, data in other_players_data.items():
-                if pid not in other_skaters:
-                    # Create new player at their current position
-                    other_skaters[pid] = Skater((data['x'], data['y']), SCALE)
-                
-                # Always update position directly
-                other_skaters[pid].pos.x = data['x']
-                other_skaters[pid].pos.y = data['y']
+                other_skaters[pid].x = data['x']
+                other_skaters[pid].y = data['y']
                 other_skaters[pid].angle = data['angle']
-                other_skaters[pid].vx = data.get('vx', 0)
-                other_skaters[pid].vy = data.get('vy', 0)
-                other_skaters[pid].crashes = data.get('crashes', 0)
+                other_skaters[pid].vx = data['vx']
+                other_skaters[pid].vy = data['vy']
+                other_skaters[pid].crashes = data['crashes']
                 
                 # Update animation for other players
                 other_skaters[pid].update_animation(dt)
-                
-                # Always update position directly
-                other_skaters[pid].pos.x = data['x']
-                other_skaters[pid].pos.y = data['y']
-                other_skaters[pid].angle = data['angle']
-                other_skaters[pid].vx = data.get('vx', 0)
-                other_skaters[pid].vy = data.get('vy', 0)
-                other_skaters[pid].crashes = data.get('crashes', 0)
+            profiler.mark("network")
 
         race_time += dt
 
-        cam_x = int(skater.pos.x - WIDTH//2)
-        cam_y = int(skater.pos.y - HEIGHT//2)
+        cam_x = int(view_x - WIDTH//2)
+        cam_y = int(view_y - HEIGHT//2)
         cam_x = max(0, min(cam_x, MAPW*TILESIZE - WIDTH))
         cam_y = max(0, min(cam_y, MAPH*TILESIZE - HEIGHT))
 
         screen.fill((30,40,55))
         draw_map(cam_x, cam_y)
+        profiler.mark("map")
         
         # Draw other players first (behind local player)
         if multiplayer:
@@ -254,10 +227,16 @@ def game_loop(multiplayer=False, server_ip='rke2.fsmn.xyz:5555'):
                 other.draw(screen, cam_x, cam_y)
         
         # Draw local player
-        skater.draw(screen, cam_x, cam_y)
+        skater.draw(screen, cam_x, cam_y, stepper.alpha)
+        profiler.mark("skaters")
         draw_hud(race_time)
+        profiler.mark("hud")
+        profiler.draw(screen)
+        profiler.mark("overlay")
         pygame.display.flip()
-
+        profiler.mark("flip")
+        profiler.end_frame()
+    grid.close()
 
     # Disconnect from server
     if multiplayer and client:
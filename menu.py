@@ -1,8 +1,12 @@
-import pygame, sys, os, json
+import pygame, sys, os, random
 import main as m, editor as ed, main_multiplayer as mm, local as lc
 import tkinter as tk
 from tkinter import simpledialog
 from songfunction import play_menu_music
+from trackgrid import TrackGrid
+from trackfile import is_track_file, save_track, TRACK_EXT
+from trackgen import generate_track, DEFAULT_WIDTH, DEFAULT_HEIGHT
+from hudtext import hud_text
 
 def ask_track_name():
     root = tk.Tk()
@@ -48,6 +52,71 @@ font3 = pygame.font.Font("assets/fonts/titlefont.otf", int(64 * SCALE))
 
 play_menu_music()
 
+BG_COLOR = (30,30,30)
+WHITE = (255,255,255)
+HOVER = (200,200,50)
+
+
+class MenuScreen:
+    """What the menu drew last frame. Every frame the menu issues its draw
+    calls again, only the items that appeared, disappeared or changed are
+    repainted and sent with display.update(rects). An idle menu draws nothing."""
+
+    MAX_DIRTY = 24  # past this many changed items just redraw everything
+
+    def __init__(self, surface, bg):
+        self.surface = surface
+        self.bg = bg
+        self.items = []    # this frame: (surface or colour, rect tuple)
+        self.last = None   # last frame's items, None forces a full redraw
+
+    def blit(self, surf, pos):
+        rect = surf.get_rect(topleft=pos)
+        self.items.append((surf, tuple(rect)))
+        return rect
+
+    def rect(self, color, rect):
+        self.items.append((color, tuple(rect)))
+        return rect
+
+    def invalidate(self):
+        """Something else drew on the screen (a game, the editor)"""
+        self.last = None
+
+    def _draw(self, item):
+        what, rect = item
+        if isinstance(what, pygame.Surface):
+            self.surface.blit(what, rect[:2])
+        else:
+            pygame.draw.rect(self.surface, what, rect)
+
+    def present(self):
+        items = self.items
+        self.items = []
+        if self.last is not None:
+            changed = set(items).symmetric_difference(self.last)
+            dirty = [pygame.Rect(rect) for rect in {rect for _, rect in changed}]
+            if len(dirty) <= self.MAX_DIRTY:
+                for area in dirty:
+                    self.surface.set_clip(area)
+                    self.surface.fill(self.bg, area)
+                    for item in items:
+                        if area.colliderect(item[1]):
+                            self._draw(item)
+                self.surface.set_clip(None)
+                if dirty:
+                    pygame.display.update(dirty)
+                self.last = items
+                return
+        self.surface.fill(self.bg)
+        for item in items:
+            self._draw(item)
+        pygame.display.flip()
+        self.last = items
+
+
+canvas = MenuScreen(screen, BG_COLOR)
+
 # Menu states
 state = "main"  # "main", "play", "editor", "settings"
 scroll_offset = 0
@@ -55,49 +124,58 @@ current_volume = VOLUME
 dragging_slider = False
 
 def draw_text(text, x, y, hover=False, title=False):
+    # Labels are rendered once and cached
     if title:
-        surf = font3.render(text, True, (255,255,255))
-        screen.blit(surf, (int(x), int(y)))
-        return surf.get_rect(topleft=(int(x), int(y)))
+        surf = hud_text.render(font3, text, WHITE)
     else:
-        color = (255,255,255) if not hover else (200,200,50)
-        surf = font2.render(text, True, color)
-        screen.blit(surf, (int(x), int(y)))
-        return surf.get_rect(topleft=(int(x), int(y)))
+        color = WHITE if not hover else HOVER
+        surf = hud_text.render(font2, text, color)
+    return canvas.blit(surf, (int(x), int(y)))
+
+def text_width(text):
+    return hud_text.render(font2, text, WHITE).get_width()
 
 def draw_slider(x, y, width, value):
     # Background bar
     bar_rect = pygame.Rect(int(x), int(y), int(width), int(10 * SCALE))
-    pygame.draw.rect(screen, (100, 100, 100), bar_rect)
+    canvas.rect((100, 100, 100), bar_rect)
     
     # Filled portion
     filled_width = int(width * value)
     filled_rect = pygame.Rect(int(x), int(y), filled_width, int(10 * SCALE))
-    pygame.draw.rect(screen, (200, 200, 50), filled_rect)
+    canvas.rect((200, 200, 50), filled_rect)
     
     # Handle
     handle_x = int(x + width * value)
     handle_rect = pygame.Rect(handle_x - int(8 * SCALE), int(y - 5 * SCALE), 
                                int(16 * SCALE), int(20 * SCALE))
-    pygame.draw.rect(screen, (255, 255, 255), handle_rect)
+    canvas.rect((255, 255, 255), handle_rect)
     
     return bar_rect, handle_rect
 
+track_list = {'mtime': None, 'tracks': []}
+
 def list_tracks():
-    files = [f for f in os.listdir("maps") if f.endswith(".json")]
-    return sorted(files)
+    # Only re-list maps/ when it changed (a track was added, removed or renamed)
+    mtime = os.stat("maps").st_mtime_ns
+    if mtime != track_list['mtime']:
+        track_list['tracks'] = sorted(f for f in os.listdir("maps") if is_track_file(f))
+        track_list['mtime'] = mtime
+    return track_list['tracks']
 
 def run_game(track):
     # Write BEFORE running the game
     with open("selected.txt", "w") as f:
         f.write(track)
     m.game_loop()
+    canvas.invalidate()
 
 def run_editor(track):
     # Write BEFORE running the editor
     with open("selected.txt", "w") as f:
         f.write(track)
     ed.game_loop()
+    canvas.invalidate()
 
 def save_settings(option, volume):
     with open("settings.txt","w") as f:
@@ -121,8 +199,8 @@ while running:
         if e.type==pygame.MOUSEBUTTONUP:
             if e.button==1:
                 dragging_slider = False
-
-    screen.fill((30,30,30))
+        if e.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED):
+            canvas.invalidate()
 
     mx,my = pygame.mouse.get_pos()
     click = pygame.mouse.get_pressed()[0]
@@ -133,13 +211,13 @@ while running:
 
     if state=="main":
         # Calculate text widths for proper centering
-        title_width = font2.render("Ice Drifter", True, (255,255,255)).get_width()
-        play_width = font2.render("Play", True, (255,255,255)).get_width()
-        multiplayer_width = font2.render("Online", True, (255,255,255)).get_width()
-        local_width = font2.render("Local", True, (255,255,255)).get_width()
-        editor_width = font2.render("Editor", True, (255,255,255)).get_width()
-        settings_width = font2.render("Settings", True, (255,255,255)).get_width()
-        exit_width = font2.render("Exit", True, (255,255,255)).get_width()
+        title_width = text_width("Ice Drifter")
+        play_width = text_width("Play")
+        multiplayer_width = text_width("Online")
+        local_width = text_width("Local")
+        editor_width = text_width("Editor")
+        settings_width = text_width("Settings")
+        exit_width = text_width("Exit")
 
         title = draw_text("Ice Drifter", WIDTH//2 - title_width//2-(40*SCALE), HEIGHT//2 - int(200*SCALE), title=True)
 
@@ -173,6 +251,7 @@ while running:
                 scroll_offset=0
             elif r2.collidepoint(mx,my):
                 mm.game_loop(multiplayer=True)
+                canvas.invalidate()
             elif r5.collidepoint(mx,my): 
                 state="local"
             elif r3.collidepoint(mx,my): 
@@ -205,6 +284,7 @@ while running:
                 with open("selected.txt", "w") as f:
                     f.write(track)
                 lc.game_loop()
+                canvas.invalidate()
             y+=spacing
 
     elif state=="editor":
@@ -222,14 +302,26 @@ while running:
                         pygame.Rect(int(100*SCALE),y+int(20*SCALE),int(300*SCALE),int(30*SCALE)).collidepoint(mx,my))
         if clicked_this_frame and rect.collidepoint(mx,my):
             # Create a simple empty grid
-            empty_grid = [["ice1" for x in range((960//32)*16)] for y in range((540//32)*16)]
+            empty_grid = TrackGrid.filled(DEFAULT_WIDTH, DEFAULT_HEIGHT, "ice1")
             name = ask_track_name()
             if name:
-                if not name.endswith(".json"):
-                    name += ".json"
+                if not is_track_file(name):
+                    name += TRACK_EXT
                 path = os.path.join("maps", name)
-                with open(path,"w") as f:
-                    json.dump(empty_grid, f)
+                save_track(path, empty_grid)
+                run_editor(name)
+        # Generated course, new random seed every time
+        rect = draw_text("[ Generate Track ]", int(100*SCALE), y+int(60*SCALE),
+                        pygame.Rect(int(100*SCALE),y+int(60*SCALE),int(300*SCALE),int(30*SCALE)).collidepoint(mx,my))
+        if clicked_this_frame and rect.collidepoint(mx,my):
+            name = ask_track_name()
+            if name:
+                if not name.endswith(TRACK_EXT):
+                    name += TRACK_EXT
+                seed = random.randrange(1 << 31)
+                result = generate_track(os.path.join("maps", name), DEFAULT_WIDTH, DEFAULT_HEIGHT, seed)
+                print(f"Generated {name} with seed {seed} "
+                      f"({result['tiles_per_sec']/1e6:.1f}M tiles/s)")
                 run_editor(name)
 
     elif state=="settings":
@@ -279,7 +371,7 @@ while running:
                 save_settings(2, current_volume)
                 draw_text("Saved!", int(350*SCALE), int(180*SCALE), False)
 
-    pygame.display.flip()
+    canvas.present()
     clock.tick(60)
 
 pygame.quit()
@@ -0,0 +1,128 @@
+import math
+
+# Input bits, one byte per frame
+TURN_LEFT = 1
+TURN_RIGHT = 2
+ACCELERATE = 4
+
+BODY_SIZE = 32  # skater sprite size at scale 1.0
+TILE_SIZE = 32  # track tile size at scale 1.0
+TURN_RATE = 200
+FRICTION = 0.98  # per step, like the surface factors in trackgrid
+
+# Physics runs in fixed steps whatever the frame rate. After a hitch at most
+# MAX_STEPS are caught up, the rest of the time is dropped.
+PHYSICS_RATE = 60
+STEP = 1 / PHYSICS_RATE
+MAX_STEPS = 8
+
+
+def per_step(factor, dt):
+    """A per-step factor (friction, surface effects) scaled to dt seconds"""
+    if dt == STEP:
+        return factor
+    return factor ** (dt * PHYSICS_RATE)
+
+
+class FixedStep:
+    """Accumulates frame time and hands it out as whole physics steps"""
+
+    def __init__(self, step=STEP, max_steps=MAX_STEPS):
+        self.step = step
+        self.max_steps = max_steps
+        self.accumulator = 0.0
+
+    def advance(self, dt):
+        """Number of steps to run for a frame of dt seconds"""
+        self.accumulator += dt
+        steps = int(self.accumulator // self.step)
+        if steps > self.max_steps:
+            steps = self.max_steps
+            self.accumulator = 0.0
+        else:
+            self.accumulator -= steps * self.step
+        return steps
+
+    @property
+    def alpha(self):
+        """How far the frame is into the next step, for drawing between steps"""
+        return self.accumulator / self.step
+
+
+def pixel(v):
+    """Round a coordinate the way pygame.Rect does"""
+    return int(v + 0.5) if v >= 0 else -int(0.5 - v)
+
+
+class SkaterState:
+    """Position and motion of one skater. No pygame in here, the server runs
+    the same code to check the inputs clients send."""
+
+    def __init__(self, x, y, angle=0.0, scale=1.0):
+        self.x = x
+        self.y = y
+        self.prev_x = x  # position before the last step
+        self.prev_y = y
+        self.vx = 0.0
+        self.vy = 0.0
+        self.angle = angle
+        self.crashes = 0
+
+        # Scale physics parameters
+        self.scale = scale
+        self.size = int(BODY_SIZE * scale)
+        self.accel = 90 * scale
+        self.max_speed = 300 * scale
+        self.turn_rate = TURN_RATE
+        self.friction = FRICTION
+
+    def body(self):
+        """Collision box (left, top, right, bottom), same as the sprite rect"""
+        left = pixel(self.x) - self.size//2
+        top = pixel(self.y) - self.size//2
+        return left, top, left + self.size, top + self.size
+
+    def lerp(self, alpha):
+        """Position alpha of the way from the previous step to this one"""
+        return (self.prev_x + (self.x - self.prev_x) * alpha,
+                self.prev_y + (self.y - self.prev_y) * alpha)
+
+    def step(self, bits, dt=STEP):
+        """Move by one step of input, returns the speed"""
+        self.prev_x = self.x
+        self.prev_y = self.y
+        if bits & TURN_LEFT:
+            self.angle -= self.turn_rate * dt
+        if bits & TURN_RIGHT:
+            self.angle += self.turn_rate * dt
+
+        if bits & ACCELERATE:
+            heading = math.radians(self.angle - 90)
+            self.vx += math.cos(heading) * self.accel * dt
+            self.vy += math.sin(heading) * self.accel * dt
+
+        friction = per_step(self.friction, dt)
+        self.vx *= friction
+        self.vy *= friction
+
+        speed = math.hypot(self.vx, self.vy)
+        if speed > self.max_speed:
+            scale_factor = self.max_speed / speed
+            self.vx *= scale_factor
+            self.vy *= scale_factor
+
+        self.x += self.vx * dt
+        self.y += self.vy * dt
+        return speed
+
+    def get_state(self):
+        return {'x': self.x, 'y': self.y, 'angle': self.angle,
+                'vx': self.vx, 'vy': self.vy, 'crashes': self.crashes}
+
+    def set_state(self, state):
+        self.x = self.prev_x = state['x']
+        self.y = self.prev_y = state['y']
+        self.angle = state['angle']
+        self.vx = state['vx']
+        self.vy = state['vy']
+        self.crashes = state['crashes']
@@ -0,0 +1,144 @@
+import csv
+import json
+import time
+import pygame
+from collections import deque
+
+PROFILE_FRAMES = 300   # frames kept in the ring buffer
+GRAPH_HEIGHT_MS = 50   # top of the frame time graph
+TARGET_MS = 1000 / 60
+
+# Overlay and trace keys
+TOGGLE_KEY = pygame.K_F3
+DUMP_KEY = pygame.K_F4
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+class FrameProfiler:
+    """Per-phase frame timings in a ring buffer, with an overlay and trace dumps.
+
+    Call begin_frame() at the top of the loop, mark(phase) after each piece
+    of work (time since the previous mark is added to that phase) and
+    end_frame() once the frame is on screen.
+    """
+
+    def __init__(self, scale=1.0, frames=PROFILE_FRAMES):
+        self.scale = scale
+        self.frames = deque(maxlen=frames)  # (start time, {phase: ms})
+        self.phases = []                    # every phase seen, in first-seen order
+        self.visible = False
+        self.font = None
+        self.current = None
+        self.frame_start = 0.0
+        self.last = 0.0
+
+    def begin_frame(self):
+        self.frame_start = self.last = time.perf_counter()
+        self.current = {}
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        current = self.current
+        if current is not None:
+            if phase not in current:
+                current[phase] = 0.0
+                if phase not in self.phases:
+                    self.phases.append(phase)
+            current[phase] += (now - self.last) * 1000
+        self.last = now
+
+    def end_frame(self):
+        if self.current is not None:
+            self.frames.append((self.frame_start, self.current))
+            self.current = None
+
+    def handle_event(self, e):
+        """F3 shows the overlay, F4 writes a trace. Returns True if it used the event"""
+        if e.type != pygame.KEYDOWN:
+            return False
+        if e.key == TOGGLE_KEY:
+            self.visible = not self.visible
+            return True
+        if e.key == DUMP_KEY:
+            path = time.strftime("profile_%Y%m%d_%H%M%S.csv")
+            self.dump(path)
+            print(f"Frame trace written to {path}")
+            return True
+        return False
+
+    def frame_times(self):
+        return [sum(phases.values()) for _, phases in self.frames]
+
+    def stats(self):
+        times = self.frame_times()
+        averages = {}
+        for phase in self.phases:
+            values = [phases.get(phase, 0.0) for _, phases in self.frames]
+            averages[phase] = sum(values) / len(values) if values else 0.0
+        return {
+            'frames': len(times),
+            'p50_ms': percentile(times, 50),
+            'p99_ms': percentile(times, 99),
+            'max_ms': max(times, default=0.0),
+            'phases_avg_ms': averages
+        }
+
+    def dump(self, path):
+        """Write the buffered frames as CSV (one row per frame) or JSON"""
+        if path.endswith(".json"):
+            with open(path, "w") as f:
+                json.dump({'phases': self.phases,
+                           'frames': [{'start': start, 'phases': phases} for start, phases in self.frames],
+                           'stats': self.stats()}, f, indent=1)
+            return
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["start"] + self.phases + ["total"])
+            for start, phases in self.frames:
+                values = [phases.get(phase, 0.0) for phase in self.phases]
+                writer.writerow([f"{start:.6f}"] + [f"{v:.3f}" for v in values] + [f"{sum(values):.3f}"])
+
+    def draw(self, surface, x=None, y=None):
+        """Overlay with p50/p99, per-phase averages and a frame time graph"""
+        if not self.visible:
+            return
+        if self.font is None:
+            self.font = pygame.font.SysFont("consolas", int(14 * self.scale))
+        stats = self.stats()
+        lines = [f"frame p50 {stats['p50_ms']:.1f}ms  p99 {stats['p99_ms']:.1f}ms  max {stats['max_ms']:.1f}ms"]
+        for phase, ms in stats['phases_avg_ms'].items():
+            lines.append(f"{phase:<10}{ms:6.2f}ms")
+
+        line_h = self.font.get_linesize()
+        graph_w = int(PROFILE_FRAMES * self.scale)
+        graph_h = int(60 * self.scale)
+        width = max(graph_w, max(self.font.size(line)[0] for line in lines)) + 8
+        height = line_h * len(lines) + graph_h + 12
+        if x is None:
+            x = surface.get_width() - width - 8
+        if y is None:
+            y = 8
+
+        panel = pygame.Surface((width, height), pygame.SRCALPHA)
+        panel.fill((0, 0, 0, 170))
+        for i, line in enumerate(lines):
+            panel.blit(self.font.render(line, True, (230, 230, 255)), (4, 4 + i*line_h))
+
+        # One bar per frame, oldest on the left, with the 60 FPS budget line
+        base = height - 4
+        target_y = base - int(TARGET_MS / GRAPH_HEIGHT_MS * graph_h)
+        pygame.draw.line(panel, (80, 160, 80), (4, target_y), (4 + graph_w, target_y))
+        times = self.frame_times()
+        step = graph_w / PROFILE_FRAMES
+        for i, ms in enumerate(times):
+            bar = min(graph_h, int(ms / GRAPH_HEIGHT_MS * graph_h))
+            color = (230, 200, 80) if ms <= TARGET_MS * 1.5 else (230, 80, 80)
+            bx = 4 + int(i * step)
+            pygame.draw.line(panel, color, (bx, base), (bx, base - bar))
+        surface.blit(panel, (x, y))
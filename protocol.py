@@ -0,0 +1,276 @@
+import json
+import struct
+
+# Binary packets start with a message type byte. JSON packets start with "{",
+# so both can arrive on the same socket and JSON stays available as a fallback.
+PROTOCOL_VERSION = 6
+
+MSG_JOIN = 1
+MSG_WELCOME = 2
+MSG_UPDATE = 3
+MSG_STATE = 4
+MSG_LEAVE = 5
+MSG_SNAPSHOT = 6
+MSG_INPUT = 7
+MSG_PLAYER_STATE = 8
+
+MSG_NAMES = {
+    MSG_JOIN: 'join',
+    MSG_WELCOME: 'welcome',
+    MSG_UPDATE: 'update',
+    MSG_STATE: 'state',
+    MSG_LEAVE: 'leave',
+    MSG_SNAPSHOT: 'snapshot',
+    MSG_INPUT: 'input',
+    MSG_PLAYER_STATE: 'player_state',
+}
+MSG_TYPES = {name: t for t, name in MSG_NAMES.items()}
+
+# Floats are sent as fixed point: 1/16 px for positions and velocities,
+# 1/65536 of a turn for angles
+POS_SCALE = 16
+VEL_SCALE = 16
+ANGLE_SCALE = 65536 / 360
+SCALE_SCALE = 1000
+
+# Join and welcome flags: the client sends inputs and the server simulates it
+FLAG_INPUTS = 1
+
+JOIN = struct.Struct("<BBiiHBHB")      # type, version, x, y, angle, flags, scale, track name length (+ name)
+WELCOME = struct.Struct("<BBIBB")      # type, version, id, flags, track name length (+ name)
+UPDATE = struct.Struct("<BiiHhhHI")    # type, x, y, angle, vx, vy, crashes, acked snapshot tick
+STATE = struct.Struct("<BH")           # type, player count (+ players)
+PLAYER = struct.Struct("<IiiHhhH")     # id, x, y, angle, vx, vy, crashes
+LEAVE = struct.Struct("<B")            # type
+# type, tick, server time in ms, baseline tick (0 for a keyframe), changed count,
+# removed count, then per changed player: id, field mask and the masked fields,
+# then removed ids
+SNAPSHOT = struct.Struct("<BIIIHH")
+REMOVED_ID = struct.Struct("<I")
+# type, acked snapshot tick, seq of the first frame, frame count, then one
+# byte of input bits per frame (a frame is one fixed physics step).
+# Clients resend every frame the server hasn't confirmed yet.
+INPUT = struct.Struct("<BIIB")
+# The server's state of the receiving player after its input seq. Full
+# precision, the client replays its newer inputs on top of it.
+PLAYER_STATE = struct.Struct("<BIdddddH")  # type, seq, x, y, angle, vx, vy, crashes
+
+# Snapshot fields in order: x, y, angle, vx, vy, crashes
+FIELD_FORMATS = "iiHhhH"
+ALL_FIELDS = (1 << len(FIELD_FORMATS)) - 1
+_ENTRY_STRUCTS = [
+    struct.Struct("<IB" + "".join(f for i, f in enumerate(FIELD_FORMATS) if mask & (1 << i)))
+    for mask in range(ALL_FIELDS + 1)
+]
+
+
+def _pos(v):
+    return int(round(v * POS_SCALE))
+
+
+def _vel(v):
+    return max(-32768, min(32767, int(round(v * VEL_SCALE))))
+
+
+def _angle(a):
+    return int(round((a % 360) * ANGLE_SCALE)) & 0xFFFF
+
+
+def _count(n):
+    return max(0, min(65535, int(n)))
+
+
+def quantize(p):
+    """Player dict to the tuple of fixed point fields that snapshots compare"""
+    return (_pos(p['x']), _pos(p['y']), _angle(p['angle']),
+            _vel(p['vx']), _vel(p['vy']), _count(p['crashes']))
+
+
+def dequantize(fields):
+    x, y, angle, vx, vy, crashes = fields
+    return {
+        'x': x / POS_SCALE,
+        'y': y / POS_SCALE,
+        'angle': angle / ANGLE_SCALE,
+        'vx': vx / VEL_SCALE,
+        'vy': vy / VEL_SCALE,
+        'crashes': crashes
+    }
+
+
+def is_json(data):
+    return data[:1] == b"{"
+
+
+def encode_json(msg):
+    return json.dumps(msg).encode('utf-8')
+
+
+def encode(msg, binary=True):
+    """Encode a message dict (same shape as the JSON messages)"""
+    if not binary:
+        return encode_json(msg)
+
+    msg_type = msg['type']
+    if msg_type == 'join':
+        name = (msg.get('track') or '').encode('utf-8')[:255]
+        flags = FLAG_INPUTS if msg.get('inputs') else 0
+        scale = max(0, min(65535, int(round(msg.get('scale', 1.0) * SCALE_SCALE))))
+        return JOIN.pack(MSG_JOIN, PROTOCOL_VERSION, _pos(msg['x']), _pos(msg['y']),
+                         _angle(msg['angle']), flags, scale, len(name)) + name
+    if msg_type == 'welcome':
+        name = msg.get('track', '').encode('utf-8')[:255]
+        flags = FLAG_INPUTS if msg.get('inputs') else 0
+        return WELCOME.pack(MSG_WELCOME, PROTOCOL_VERSION, msg['id'], flags, len(name)) + name
+    if msg_type == 'update':
+        return UPDATE.pack(MSG_UPDATE, _pos(msg['x']), _pos(msg['y']), _angle(msg['angle']),
+                           _vel(msg['vx']), _vel(msg['vy']), _count(msg['crashes']),
+                           msg.get('ack', 0))
+    if msg_type == 'state':
+        return encode_state(msg['players'])
+    if msg_type == 'leave':
+        return LEAVE.pack(MSG_LEAVE)
+    if msg_type == 'input':
+        frames = msg['frames'][-255:]
+        seq = msg['seq'] + len(msg['frames']) - len(frames)
+        return INPUT.pack(MSG_INPUT, msg.get('ack', 0), seq, len(frames)) + bytes(frames)
+    if msg_type == 'player_state':
+        return PLAYER_STATE.pack(MSG_PLAYER_STATE, msg['seq'], msg['x'], msg['y'], msg['angle'],
+                                 msg['vx'], msg['vy'], _count(msg['crashes']))
+    raise ValueError(f"Unknown message type {msg_type!r}")
+
+
+def encode_state(players):
+    """Binary state packet from a list of player dicts"""
+    parts = [STATE.pack(MSG_STATE, len(players))]
+    for p in players:
+        parts.append(PLAYER.pack(p['id'], _pos(p['x']), _pos(p['y']), _angle(p['angle']),
+                                 _vel(p['vx']), _vel(p['vy']), _count(p['crashes'])))
+    return b"".join(parts)
+
+
+def _entry(pid, fields, old):
+    """Snapshot entry with the fields that differ from old (all of them if
+    old is None), or None if nothing changed"""
+    if old is None:
+        return _ENTRY_STRUCTS[ALL_FIELDS].pack(pid, ALL_FIELDS, *fields)
+    mask = 0
+    changed = []
+    for i, value in enumerate(fields):
+        if value != old[i]:
+            mask |= 1 << i
+            changed.append(value)
+    if not mask:
+        return None
+    return _ENTRY_STRUCTS[mask].pack(pid, mask, *changed)
+
+
+def encode_changes(tick, server_time, baseline_tick, changes, removed):
+    """Snapshot packet from changes already worked out by the caller:
+    [(id, fields, fields at the baseline or None)] plus the removed ids"""
+    entries = []
+    for pid, fields, old in changes:
+        if old is fields:
+            continue  # Same entry carried over, nothing to compare
+        entry = _entry(pid, fields, old)
+        if entry is not None:
+            entries.append(entry)
+    header = SNAPSHOT.pack(MSG_SNAPSHOT, tick, int(server_time * 1000) & 0xFFFFFFFF,
+                           baseline_tick, len(entries), len(removed))
+    return header + b"".join(entries) + b"".join(REMOVED_ID.pack(pid) for pid in removed)
+
+
+def encode_snapshot(tick, server_time, snapshot, baseline_tick=0, baseline=None):
+    """Snapshot packet with only the fields that changed since baseline.
+
+    snapshot and baseline are {id: quantized fields}. Without a baseline
+    this is a keyframe carrying every field of every player.
+    """
+    if baseline is None:
+        baseline_tick = 0
+        baseline = {}
+    changes = [(pid, fields, baseline.get(pid)) for pid, fields in snapshot.items()]
+    removed = [pid for pid in baseline if pid not in snapshot]
+    return encode_changes(tick, server_time, baseline_tick, changes, removed)
+
+
+def apply_snapshot(msg, baseline):
+    """Rebuild the full {id: quantized fields} from a decoded snapshot and its baseline"""
+    snapshot = dict(baseline) if msg['baseline'] else {}
+    for pid in msg['removed']:
+        snapshot.pop(pid, None)
+    for pid, mask, values in msg['changed']:
+        fields = list(snapshot.get(pid, (0,) * len(FIELD_FORMATS)))
+        values = iter(values)
+        for i in range(len(FIELD_FORMATS)):
+            if mask & (1 << i):
+                fields[i] = next(values)
+        snapshot[pid] = tuple(fields)
+    return snapshot
+
+
+def _player(values):
+    pid, x, y, angle, vx, vy, crashes = values
+    return {
+        'id': pid,
+        'x': x / POS_SCALE,
+        'y': y / POS_SCALE,
+        'angle': angle / ANGLE_SCALE,
+        'vx': vx / VEL_SCALE,
+        'vy': vy / VEL_SCALE,
+        'crashes': crashes
+    }
+
+
+def decode(data):
+    """Decode a packet of either format into a message dict"""
+    if is_json(data):
+        return json.loads(data.decode('utf-8'))
+
+    msg_type = data[0]
+    if msg_type == MSG_JOIN:
+        if data[1] != PROTOCOL_VERSION:
+            # Other versions lay the join out differently, only the version is read
+            return {'type': 'join', 'version': data[1]}
+        _, version, x, y, angle, flags, scale, n = JOIN.unpack_from(data)
+        track = bytes(data[JOIN.size:JOIN.size + n]).decode('utf-8')
+        return {'type': 'join', 'version': version, 'x': x / POS_SCALE, 'y': y / POS_SCALE,
+                'angle': angle / ANGLE_SCALE, 'inputs': bool(flags & FLAG_INPUTS),
+                'scale': scale / SCALE_SCALE, 'track': track}
+    if msg_type == MSG_WELCOME:
+        _, version, pid, flags, n = WELCOME.unpack_from(data)
+        track = bytes(data[WELCOME.size:WELCOME.size + n]).decode('utf-8')
+        return {'type': 'welcome', 'version': version, 'id': pid,
+                'inputs': bool(flags & FLAG_INPUTS), 'track': track}
+    if msg_type == MSG_UPDATE:
+        _, x, y, angle, vx, vy, crashes, ack = UPDATE.unpack_from(data)
+        return {'type': 'update', 'x': x / POS_SCALE, 'y': y / POS_SCALE,
+                'angle': angle / ANGLE_SCALE, 'vx': vx / VEL_SCALE, 'vy': vy / VEL_SCALE,
+                'crashes': crashes, 'ack': ack}
+    if msg_type == MSG_STATE:
+        _, count = STATE.unpack_from(data)
+        players = [_player(v) for v in PLAYER.iter_unpack(data[STATE.size:STATE.size + count*PLAYER.size])]
+        return {'type': 'state', 'players': players}
+    if msg_type == MSG_LEAVE:
+        return {'type': 'leave'}
+    if msg_type == MSG_SNAPSHOT:
+        _, tick, time_ms, baseline, n_changed, n_removed = SNAPSHOT.unpack_from(data)
+        offset = SNAPSHOT.size
+        changed = []
+        for _ in range(n_changed):
+            mask = data[offset + 4]
+            values = _ENTRY_STRUCTS[mask].unpack_from(data, offset)
+            changed.append((values[0], mask, values[2:]))
+            offset += _ENTRY_STRUCTS[mask].size
+        removed = [pid for (pid,) in REMOVED_ID.iter_unpack(data[offset:offset + n_removed*REMOVED_ID.size])]
+        return {'type': 'snapshot', 'tick': tick, 'time': time_ms / 1000, 'baseline': baseline,
+                'changed': changed, 'removed': removed}
+    if msg_type == MSG_INPUT:
+        _, ack, seq, count = INPUT.unpack_from(data)
+        frames = list(data[INPUT.size:INPUT.size + count])
+        return {'type': 'input', 'ack': ack, 'seq': seq, 'frames': frames}
+    if msg_type == MSG_PLAYER_STATE:
+        _, seq, x, y, angle, vx, vy, crashes = PLAYER_STATE.unpack_from(data)
+        return {'type': 'player_state', 'seq': seq, 'x': x, 'y': y, 'angle': angle,
+                'vx': vx, 'vy': vy, 'crashes': crashes}
+    raise ValueError(f"Unknown message type {msg_type}")
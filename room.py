@@ -0,0 +1,443 @@
+import math
+import os
+import time
+from collections import defaultdict, deque, OrderedDict
+from protocol import decode, encode, encode_json, encode_changes, is_json, quantize, PROTOCOL_VERSION, POS_SCALE
+from physics import SkaterState, STEP, TILE_SIZE
+from trackfile import load_track
+
+# Snapshots kept as delta baselines, and how often a full keyframe is forced
+SNAPSHOT_HISTORY = 32
+KEYFRAME_INTERVAL = 60
+
+# Area of interest: players in the grid cells under a client's view (plus a
+# margin) are sent every tick. The far ones are sent round robin, about
+# 1/FAR_INTERVAL of them per tick, so each is refreshed every FAR_INTERVAL
+# ticks without bursts.
+VIEW_WIDTH, VIEW_HEIGHT = 960, 540  # view at scale 1.0, in world pixels
+AOI_MARGIN = 256
+AOI_CELL = 512
+FAR_INTERVAL = 10
+
+TICK_RATE = 30
+STATS_WINDOW = 300       # ticks of jitter samples kept
+STATS_INTERVAL = 10.0    # seconds between stats reports
+MAX_ROOM_PLAYERS = 32
+STALE_TIMEOUT = 5.0
+# How far a client's input steps may run ahead of the wall clock before
+# they are dropped (speed hack guard)
+MAX_INPUT_LEAD = 1.0
+
+# Biggest coordinate that still fits the int32 fixed point snapshot fields
+MAX_COORD = (2**31 - 1) // POS_SCALE
+MAX_SEQ = 2**32 - 1
+
+
+def number(value, default, limit=MAX_COORD):
+    """value if it is a finite number within +-limit, otherwise default.
+    JSON clients can send anything, and one bad field must not reach the
+    snapshot encoder (it would take down the whole room worker)."""
+    if (isinstance(value, (int, float)) and not isinstance(value, bool)
+            and math.isfinite(value) and -limit <= value <= limit):
+        return value
+    return default
+
+
+def counter(value, default, limit=MAX_SEQ):
+    """value if it is a whole number in 0..limit, otherwise default"""
+    if isinstance(value, int) and not isinstance(value, bool) and 0 <= value <= limit:
+        return value
+    return default
+
+
+class Room:
+    """One race: a track, its players and their snapshot state.
+
+    Rooms never touch a socket, every method returns the (data, addr)
+    packets to send.
+    """
+
+    def __init__(self, room_id, track):
+        self.room_id = room_id
+        self.track = track
+
+        # Track to simulate input-mode players on
+        try:
+            self.grid = load_track(os.path.join("maps", track))
+        except Exception as e:
+            print(f"Room {room_id}: can't load {track} ({e}), only position updates accepted")
+            self.grid = None
+
+        # Player data: {addr: {'id', 'x', 'y', 'angle', 'vx', 'vy', 'crashes', 'last_update', 'binary'}}
+        # Input-mode players also have 'sim', the SkaterState the server moves
+        self.players = {}
+        self.next_id = 0
+
+        # Delta snapshots. Every binary player keeps its current view and an
+        # undo log of the ticks it was sent:
+        # {tick: {id: quantized fields}}
+        self.tick = 0
+        self.started = time.perf_counter()  # snapshot timestamps count from here
+        self.departed = set()  # ids removed since the last broadcast
+        self.gone = []         # addrs that left, timed out or were refused
+
+    def handle_message(self, data, addr):
+        out = []
+        try:
+            binary = not is_json(data)
+            msg = decode(data)
+            msg_type = msg.get('type')
+
+            if msg_type == 'join':
+                # New player joining
+                if binary and msg.get('version', 0) != PROTOCOL_VERSION:
+                    # Different binary protocol, the client will retry with JSON
+                    self.gone.append(addr)
+                    return out
+                if addr not in self.players:
+                    player_id = self.next_id
+                    self.next_id += 1
+                    x = number(msg.get('x'), 100)
+                    y = number(msg.get('y'), 100)
+                    angle = number(msg.get('angle'), 0)
+                    scale = max(0.25, min(4.0, number(msg.get('scale'), 1.0)))
+                    sim = None
+                    if msg.get('inputs') and self.grid is not None:
+                        sim = SkaterState(x, y, angle, scale)
+                    self.players[addr] = {
+                        'id': player_id,
+                        'x': x,
+                        'y': y,
+                        'angle': angle,
+                        'vx': 0,
+                        'vy': 0,
+                        'crashes': 0,
+                        'last_update': time.time(),
+                        'binary': binary,
+                        'ack': 0,
+                        'last_keyframe': 0,
+                        'scale': scale,
+                        'known': {},           # {id: fields} the client has as of the last tick sent
+                        'undo': OrderedDict(), # {tick: {id: fields before that tick, None if absent}}
+                        'far_cursor': player_id,
+                        'sim': sim,
+                        'seq': 0,           # last input frame simulated
+                        'sent_seq': 0,      # last seq the client was told about
+                        'sim_time': 0.0,    # frame time simulated so far
+                        'joined': time.time()
+                    }
+                    print(f"Room {self.room_id}: player {player_id} joined from {addr}")
+
+                    # Send welcome message with player ID and track
+                    response = {
+                        'type': 'welcome',
+                        'id': player_id,
+                        'track': self.track,
+                        'inputs': sim is not None
+                    }
+                    out.append((encode(response, binary), addr))
+
+            elif msg_type == 'update':
+                # Player position update, input-mode players can't set their own.
+                # Missing or broken fields keep their previous value.
+                p = self.players.get(addr)
+                if p is not None and p['sim'] is None:
+                    p.update({
+                        'x': number(msg.get('x'), p['x']),
+                        'y': number(msg.get('y'), p['y']),
+                        'angle': number(msg.get('angle'), p['angle']),
+                        'vx': number(msg.get('vx'), 0),
+                        'vy': number(msg.get('vy'), 0),
+                        'crashes': counter(msg.get('crashes'), p['crashes'], 65535),
+                        'last_update': time.time()
+                    })
+                    # Last snapshot the client received, used as its delta baseline
+                    ack = counter(msg.get('ack'), 0)
+                    if ack > p['ack']:
+                        p['ack'] = ack
+
+            elif msg_type == 'input':
+                # Input frames, run through the same physics as the client
+                p = self.players.get(addr)
+                seq = counter(msg.get('seq'), None)
+                frames = msg.get('frames')
+                if (p is not None and p['sim'] is not None and seq is not None
+                        and isinstance(frames, (list, bytes, bytearray))
+                        and all(counter(bits, None, 255) is not None for bits in frames)):
+                    simulated = p['seq']
+                    self.apply_inputs(p, seq, frames[:MAX_SEQ - seq])
+                    if p['seq'] == simulated:
+                        # Nothing new, the client may have missed our last
+                        # state: send it again
+                        p['sent_seq'] = None
+                    p['last_update'] = time.time()
+                    ack = counter(msg.get('ack'), 0)
+                    if ack > p['ack']:
+                        p['ack'] = ack
+
+            elif msg_type == 'leave':
+                # Player leaving
+                if addr in self.players:
+                    player_id = self.players[addr]['id']
+                    del self.players[addr]
+                    self.departed.add(player_id)
+                    self.gone.append(addr)
+                    print(f"Room {self.room_id}: player {player_id} left")
+
+        except Exception as e:
+            print(f"Error handling message: {e}")
+        return out
+
+    def apply_inputs(self, p, seq, frames):
+        """Simulate the frames the player hasn't been moved by yet.
+        frames are input bits, one per physics step, starting at input number seq."""
+        sim = p['sim']
+        budget = time.time() - p['joined'] + MAX_INPUT_LEAD - p['sim_time']
+        tilesize = int(TILE_SIZE * sim.scale)
+        for i, bits in enumerate(frames):
+            if seq + i <= p['seq']:
+                continue  # Already simulated, resent in case it was lost
+            if seq + i > p['seq'] + 1:
+                break  # A frame is missing, the client resends from it
+            if STEP > budget:
+                break  # Client is running faster than real time
+            budget -= STEP
+            p['sim_time'] += STEP
+            sim.step(bits)
+            self.grid.apply_surface_effects(sim, tilesize)
+            p['seq'] = seq + i
+        p.update(sim.get_state())
+
+    def broadcast_game_state(self):
+        out = []
+        # Remove stale players (no update in 5 seconds)
+        current_time = time.time()
+        stale_addrs = [addr for addr, p in self.players.items()
+                       if current_time - p['last_update'] > STALE_TIMEOUT]
+        for addr in stale_addrs:
+            print(f"Room {self.room_id}: removing stale player {self.players[addr]['id']}")
+            self.departed.add(self.players[addr]['id'])
+            self.gone.append(addr)
+            del self.players[addr]
+
+        if not self.players:
+            self.departed.clear()
+            return out
+
+        # This tick's snapshot and a spatial grid of player positions
+        self.tick += 1
+        server_time = time.perf_counter() - self.started
+        snapshot = {}
+        cells = defaultdict(list)
+        for p in self.players.values():
+            snapshot[p['id']] = quantize(p)
+            cells[(int(p['x'] // AOI_CELL), int(p['y'] // AOI_CELL))].append(p['id'])
+        order = list(snapshot)  # far players are sent round robin in this order
+
+        json_data = None
+        for addr, p in self.players.items():
+            if p['binary']:
+                data = self.client_snapshot(p, snapshot, cells, order, server_time)
+            else:
+                if json_data is None:
+                    json_data = encode_json({'type': 'state', 'tick': self.tick, 'time': server_time, 'players': [
+                        {
+                            'id': q['id'],
+                            'x': q['x'],
+                            'y': q['y'],
+                            'angle': q['angle'],
+                            'vx': q['vx'],
+                            'vy': q['vy'],
+                            'crashes': q['crashes']
+                        }
+                        for q in self.players.values()
+                    ]})
+                data = json_data
+            out.append((data, addr))
+
+            # Input-mode players get their own state for reconciliation
+            if p['sim'] is not None and p['seq'] != p['sent_seq']:
+                p['sent_seq'] = p['seq']
+                state = p['sim'].get_state()
+                state.update({'type': 'player_state', 'seq': p['seq']})
+                out.append((encode(state, p['binary']), addr))
+        self.departed.clear()
+        return out
+
+    def near_ids(self, p, cells):
+        """Players in the cells under the client's view"""
+        half_w = VIEW_WIDTH * p['scale'] / 2 + AOI_MARGIN
+        half_h = VIEW_HEIGHT * p['scale'] / 2 + AOI_MARGIN
+        x0, x1 = int((p['x'] - half_w) // AOI_CELL), int((p['x'] + half_w) // AOI_CELL)
+        y0, y1 = int((p['y'] - half_h) // AOI_CELL), int((p['y'] + half_h) // AOI_CELL)
+        near = []
+        for cy in range(y0, y1 + 1):
+            for cx in range(x0, x1 + 1):
+                near.extend(cells.get((cx, cy), ()))
+        return near
+
+    def far_ids(self, p, order):
+        """The next 1/FAR_INTERVAL of the lobby for this client's round robin"""
+        n = len(order)
+        count = -(-n // FAR_INTERVAL)
+        start = p['far_cursor'] % n
+        p['far_cursor'] = start + count
+        return order[start:start + count] + order[:max(0, start + count - n)]
+
+    def client_snapshot(self, p, snapshot, cells, order, server_time):
+        """Snapshot packet for one binary client.
+
+        The client's view ('known') keeps the last value sent for every
+        player. Each tick only the nearby players and a round robin slice of
+        the far ones are refreshed, and the undo log of each tick records
+        what those changes replaced. The delta against the acked tick is
+        rebuilt from the undo logs since then, so the work per client is
+        the nearby players plus what changed since its ack, not the lobby.
+        A keyframe (every KEYFRAME_INTERVAL ticks, or when the ack is too
+        old) refreshes and sends everything.
+        """
+        known = p['known']
+        undo_log = p['undo']
+        baseline_tick = p['ack']
+        keyframe = (baseline_tick not in undo_log
+                    or self.tick - p['last_keyframe'] >= KEYFRAME_INTERVAL)
+
+        undo = {}
+        if keyframe:
+            p['last_keyframe'] = self.tick
+            refresh = order
+            for pid in [pid for pid in known if pid not in snapshot]:
+                undo[pid] = known.pop(pid)
+        else:
+            refresh = self.near_ids(p, cells) + self.far_ids(p, order)
+            for pid in self.departed:
+                if pid in known:
+                    undo[pid] = known.pop(pid)
+        for pid in refresh:
+            fields = snapshot[pid]
+            old = known.get(pid)
+            if old != fields:
+                undo.setdefault(pid, old)
+                known[pid] = fields
+        undo_log[self.tick] = undo
+        while len(undo_log) > SNAPSHOT_HISTORY:
+            undo_log.popitem(last=False)
+
+        if keyframe:
+            return encode_changes(self.tick, server_time, 0,
+                                  [(pid, fields, None) for pid, fields in known.items()], [])
+
+        # Value at the baseline of everything changed since: the oldest undo
+        # entry after the baseline tick wins
+        at_baseline = {}
+        for tick in reversed(undo_log):
+            if tick <= baseline_tick:
+                break
+            at_baseline.update(undo_log[tick])
+        changes = []
+        removed = []
+        for pid, old in at_baseline.items():
+            fields = known.get(pid)
+            if fields is None:
+                if old is not None:
+                    removed.append(pid)
+            else:
+                changes.append((pid, fields, old))
+        return encode_changes(self.tick, server_time, baseline_tick, changes, removed)
+
+
+class RoomHost:
+    """The rooms served by one process, all ticked together"""
+
+    def __init__(self):
+        self.rooms = {}
+        # How late each tick fired
+        self.tick_jitter = deque(maxlen=STATS_WINDOW)
+
+    def create(self, room_id, track):
+        self.rooms[room_id] = Room(room_id, track)
+        print(f"Room {room_id} opened on {track}")
+
+    def close(self, room_id):
+        room = self.rooms.pop(room_id, None)
+        if room is not None:
+            if room.grid is not None:
+                room.grid.close()
+            print(f"Room {room_id} closed")
+
+    def handle(self, packets):
+        """packets: [(room_id, data, addr)], returns the packets to send"""
+        out = []
+        for room_id, data, addr in packets:
+            room = self.rooms.get(room_id)
+            if room is not None:
+                out.extend(room.handle_message(data, addr))
+        return out
+
+    def tick(self, lateness=0.0):
+        self.tick_jitter.append(lateness)
+        out = []
+        for room in self.rooms.values():
+            out.extend(room.broadcast_game_state())
+        return out
+
+    def collect_gone(self):
+        gone = []
+        for room in self.rooms.values():
+            gone.extend(room.gone)
+            room.gone.clear()
+        return gone
+
+    def get_stats(self):
+        jitter = self.tick_jitter or [0.0]
+        return {
+            'rooms': len(self.rooms),
+            'players': sum(len(r.players) for r in self.rooms.values()),
+            'jitter_avg_ms': 1000 * sum(jitter) / len(jitter),
+            'jitter_max_ms': 1000 * max(jitter)
+        }
+
+
+def run_worker(conn, outbox):
+    """Room worker process. Talks to the front door over two pipes:
+    in:  ('create', room_id, track), ('close', room_id),
+         ('packets', [(room_id, data, addr)]), ('stop',)
+    out: ('out', [(data, addr)], [gone addrs]), ('stats', stats)
+    """
+    host = RoomHost()
+    tick_interval = 1 / TICK_RATE
+    next_tick = time.perf_counter() + tick_interval
+    next_stats = time.perf_counter() + STATS_INTERVAL
+
+    while True:
+        out = []
+        timeout = max(0.0, next_tick - time.perf_counter())
+        if conn.poll(timeout):
+            while conn.poll(0):
+                try:
+                    msg = conn.recv()
+                except EOFError:
+                    return
+                if msg[0] == 'packets':
+                    out.extend(host.handle(msg[1]))
+                elif msg[0] == 'create':
+                    host.create(msg[1], msg[2])
+                elif msg[0] == 'close':
+                    host.close(msg[1])
+                elif msg[0] == 'stop':
+                    return
+
+        now = time.perf_counter()
+        if now >= next_tick:
+            out.extend(host.tick(now - next_tick))
+            # Keep the cadence fixed, unless we fell a whole tick behind
+            next_tick += tick_interval
+            if now - next_tick > tick_interval:
+                next_tick = now + tick_interval
+
+        gone = host.collect_gone()
+        if out or gone:
+            outbox.send(('out', out, gone))
+        if now >= next_stats:
+            outbox.send(('stats', host.get_stats()))
+            next_stats = now + STATS_INTERVAL
@@ -1,147 +1,249 @@
 import socket
-import json
+import selectors
 import time
 import threading
-from collections import defaultdict
+import os
+import queue
+import multiprocessing
+from collections import deque
+from protocol import decode, is_json, MSG_JOIN
+from room import RoomHost, run_worker, MAX_ROOM_PLAYERS, TICK_RATE, STATS_WINDOW, STATS_INTERVAL
+from trackfile import is_track_file
+
+# Datagrams read per wakeup at most, so a flood can't hold off the ticks
+MAX_DRAIN = 256
 
 class GameServer:
-    def __init__(self, host='0.0.0.0', port=5555):
+    """Front door: owns the UDP socket and routes each player to a room.
+
+    Rooms run in a pool of worker processes (or in this process with
+    workers=0). Joins pick or open a room for the requested track, every
+    other datagram is forwarded to the room its sender joined.
+    """
+
+    def __init__(self, host='0.0.0.0', port=5555, workers=None):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.bind((host, port))
-        self.sock.settimeout(0.1)
-        
-        # Player data: {addr: {'id', 'x', 'y', 'angle', 'vx', 'vy', 'crashes', 'last_update'}}
-        self.players = {}
-        self.next_id = 0
+        self.sock.setblocking(False)
         self.running = True
-        
-        # Track selection
-        self.current_track = "track1.json"
-        
-        print(f"Server started on {host}:{port}")
-        print(f"Current track: {self.current_track}")
-    
-    def handle_message(self, data, addr):
-        try:
-            msg = json.loads(data.decode('utf-8'))
-            msg_type = msg.get('type')
-            
-            if msg_type == 'join':
-                # New player joining
-                if addr not in self.players:
-                    player_id = self.next_id
-                    self.next_id += 1
-                    self.players[addr] = {
-                        'id': player_id,
-                        'x': msg.get('x', 100),
-                        'y': msg.get('y', 100),
-                        'angle': msg.get('angle', 0),
-                        'vx': 0,
-                        'vy': 0,
-                        'crashes': 0,
-                        'last_update': time.time()
-                    }
-                    print(f"Player {player_id} joined from {addr}")
-                    
-                    # Send welcome message with player ID and track
-                    response = {
-                        'type': 'welcome',
-                        'id': player_id,
-                        'track': self.current_track
-                    }
-                    self.sock.sendto(json.dumps(response).encode('utf-8'), addr)
-            
-            elif msg_type == 'update':
-                # Player position update
-                if addr in self.players:
-                    self.players[addr].update({
-                        'x': msg.get('x'),
-                        'y': msg.get('y'),
-                        'angle': msg.get('angle'),
-                        'vx': msg.get('vx', 0),
-                        'vy': msg.get('vy', 0),
-                        'crashes': msg.get('crashes', 0),
-                        'last_update': time.time()
-                    })
-            
-            elif msg_type == 'leave':
-                # Player leaving
-                if addr in self.players:
-                    player_id = self.players[addr]['id']
-                    del self.players[addr]
-                    print(f"Player {player_id} left")
-        
-        except Exception as e:
-            print(f"Error handling message: {e}")
-    
-    def broadcast_game_state(self):
-        # Remove stale players (no update in 5 seconds)
-        current_time = time.time()
-        stale_addrs = [addr for addr, p in self.players.items() 
-                       if current_time - p['last_update'] > 5.0]
-        for addr in stale_addrs:
-            print(f"Removing stale player {self.players[addr]['id']}")
-            del self.players[addr]
-        
-        if not self.players:
-            return
-        
-        # Prepare game state
-        game_state = {
-            'type': 'state',
-            'players': [
-                {
-                    'id': p['id'],
-                    'x': p['x'],
-                    'y': p['y'],
-                    'angle': p['angle'],
-                    'vx': p['vx'],
-                    'vy': p['vy'],
-                    'crashes': p['crashes']
-                }
-                for p in self.players.values()
-            ]
-        }
-        
-        # Send to all players
-        state_data = json.dumps(game_state).encode('utf-8')
-        for addr in self.players.keys():
+
+        # Track used when a join doesn't ask for one
+        self.current_track = "track1.trk"
+
+        # Routing: {addr: room_id} and {room_id: {'track', 'worker', 'players'}}
+        self.routes = {}
+        self.rooms = {}
+        self.next_room = 0
+
+        # Datagrams waiting per wakeup, and the workers' latest stats
+        self.queue_depth = deque(maxlen=STATS_WINDOW)
+        self.worker_stats = {}
+
+        # Worker processes, each with a thread sending out what it produces.
+        # Their room departures come back to the main loop through events.
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.events = queue.SimpleQueue()
+        self.workers = []
+        self.local = RoomHost() if workers == 0 else None
+        for index in range(workers):
+            inbox_reader, inbox = multiprocessing.Pipe(duplex=False)
+            outbox, outbox_writer = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=run_worker, args=(inbox_reader, outbox_writer),
+                                              daemon=True)
+            process.start()
+            threading.Thread(target=self._worker_reader, args=(index, outbox), daemon=True).start()
+            self.workers.append((process, inbox))
+
+        print(f"Server started on {host}:{port} with {workers or 'no'} room workers")
+        print(f"Default track: {self.current_track}")
+
+    def _worker_reader(self, index, conn):
+        """Background thread sending a worker's packets out"""
+        while self.running:
+            try:
+                msg = conn.recv()
+            except (EOFError, OSError):
+                break
+            if msg[0] == 'out':
+                self.send_all(msg[1])
+                if msg[2]:
+                    self.events.put(msg[2])
+            elif msg[0] == 'stats':
+                self.worker_stats[index] = msg[1]
+
+    def send_all(self, packets):
+        for data, addr in packets:
             try:
-                self.sock.sendto(state_data, addr)
+                self.sock.sendto(data, addr)
             except Exception as e:
                 print(f"Error sending to {addr}: {e}")
-    
-    def run(self):
-        last_broadcast = time.time()
-        broadcast_rate = 1/30  # 30 updates per second
-        
-        while self.running:
-            # Receive messages
+
+    def pick_room(self, track):
+        """Room to put a joining player in, opening one if needed"""
+        # Only tracks that exist in maps/ can be requested
+        track = os.path.basename(track or "")
+        if not is_track_file(track) or not os.path.exists(os.path.join("maps", track)):
+            track = self.current_track
+
+        for room_id, room in self.rooms.items():
+            if room['track'] == track and room['players'] < MAX_ROOM_PLAYERS:
+                return room_id
+
+        room_id = self.next_room
+        self.next_room += 1
+        worker = None
+        if self.workers:
+            # Least loaded worker
+            load = [0] * len(self.workers)
+            for room in self.rooms.values():
+                load[room['worker']] += room['players']
+            worker = load.index(min(load))
+            self.workers[worker][1].send(('create', room_id, track))
+        else:
+            self.local.create(room_id, track)
+        self.rooms[room_id] = {'track': track, 'worker': worker, 'players': 0}
+        return room_id
+
+    def route(self, data, addr):
+        """Room id for a datagram, or None to drop it"""
+        room_id = self.routes.get(addr)
+        if room_id is not None:
+            return room_id
+
+        # Unknown sender: only a join gets through
+        if not (is_json(data) or data[:1] == bytes([MSG_JOIN])):
+            return None
+        try:
+            msg = decode(data)
+        except Exception as e:
+            print(f"Error handling message: {e}")
+            return None
+        if msg.get('type') != 'join':
+            return None
+        room_id = self.pick_room(msg.get('track'))
+        self.routes[addr] = room_id
+        self.rooms[room_id]['players'] += 1
+        return room_id
+
+    def player_gone(self, addrs):
+        for addr in addrs:
+            room_id = self.routes.pop(addr, None)
+            if room_id is None:
+                continue
+            room = self.rooms[room_id]
+            room['players'] -= 1
+            if room['players'] <= 0:
+                # Last player left, free the room
+                del self.rooms[room_id]
+                if room['worker'] is None:
+                    self.local.close(room_id)
+                else:
+                    self.workers[room['worker']][1].send(('close', room_id))
+
+    def drain_socket(self):
+        """Route the datagrams that are waiting (MAX_DRAIN at most, the rest
+        are read on the next wakeup), returns how many were read"""
+        count = 0
+        batches = {}
+        for _ in range(MAX_DRAIN):
             try:
                 data, addr = self.sock.recvfrom(4096)
-                self.handle_message(data, addr)
-            except socket.timeout:
-                pass
+            except BlockingIOError:
+                break
+            except ConnectionResetError:
+                # Windows reports an unreachable client on the next recv
+                continue
             except Exception as e:
                 print(f"Receive error: {e}")
-            
-            # Broadcast game state at fixed rate
-            current_time = time.time()
-            if current_time - last_broadcast >= broadcast_rate:
-                self.broadcast_game_state()
-                last_broadcast = current_time
-            
-            time.sleep(0.001)  # Small sleep to prevent CPU spinning
-    
+                break
+            count += 1
+            room_id = self.route(data, addr)
+            if room_id is not None:
+                batches.setdefault(self.rooms[room_id]['worker'], []).append((room_id, data, addr))
+
+        # One pipe message per worker per wakeup
+        for worker, packets in batches.items():
+            if worker is None:
+                self.send_all(self.local.handle(packets))
+            else:
+                self.workers[worker][1].send(('packets', packets))
+        return count
+
+    def get_stats(self):
+        depth = self.queue_depth or [0]
+        workers = list(self.worker_stats.values())
+        if self.local:
+            workers.append(self.local.get_stats())
+        return {
+            'rooms': len(self.rooms),
+            'players': len(self.routes),
+            'queue_avg': sum(depth) / len(depth),
+            'queue_max': max(depth),
+            'jitter_avg_ms': max((w['jitter_avg_ms'] for w in workers), default=0.0),
+            'jitter_max_ms': max((w['jitter_max_ms'] for w in workers), default=0.0)
+        }
+
+    def run(self):
+        # Wake up on incoming datagrams, when the next local tick is due, or
+        # often enough to pick up worker events
+        selector = selectors.DefaultSelector()
+        selector.register(self.sock, selectors.EVENT_READ)
+        tick_interval = 1 / TICK_RATE
+        next_tick = time.perf_counter() + tick_interval
+        next_stats = time.perf_counter() + STATS_INTERVAL
+
+        try:
+            while self.running:
+                if self.local:
+                    timeout = max(0.0, next_tick - time.perf_counter())
+                else:
+                    timeout = 0.1
+                if selector.select(timeout):
+                    self.queue_depth.append(self.drain_socket())
+
+                while True:
+                    try:
+                        self.player_gone(self.events.get_nowait())
+                    except queue.Empty:
+                        break
+
+                now = time.perf_counter()
+                if self.local and now >= next_tick:
+                    self.send_all(self.local.tick(now - next_tick))
+                    # Keep the cadence fixed, unless we fell a whole tick behind
+                    next_tick += tick_interval
+                    if now - next_tick > tick_interval:
+                        next_tick = now + tick_interval
+                if self.local:
+                    self.player_gone(self.local.collect_gone())
+
+                if now >= next_stats:
+                    stats = self.get_stats()
+                    if stats['players']:
+                        print(f"{stats['rooms']} rooms, {stats['players']} players, "
+                              f"jitter {stats['jitter_avg_ms']:.2f}ms avg / {stats['jitter_max_ms']:.2f}ms max, "
+                              f"queue {stats['queue_avg']:.1f} avg / {stats['queue_max']} max")
+                    next_stats = now + STATS_INTERVAL
+        finally:
+            selector.close()
+
     def stop(self):
         self.running = False
+        for process, conn in self.workers:
+            try:
+                conn.send(('stop',))
+            except OSError:
+                pass
+            process.join(timeout=1.0)
         self.sock.close()
         print("Server stopped")
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     server = GameServer()
     try:
         server.run()
     except KeyboardInterrupt:
         print("\nShutting down server...")
-        server.stop()
\ No newline at end of file
+        server.stop()
@@ -1,91 +1,53 @@
-import pygame, os
+import pygame
 from pygame.math import Vector2
+from spritecache import rotation_cache
+from assets import assets
+from physics import SkaterState, TURN_LEFT, TURN_RIGHT, ACCELERATE, STEP
 import math
-import sys
 
-def resource_path(relative_path):
-    # Funziona sia in sviluppo che in build
-    if hasattr(sys, '_MEIPASS'):
-        return os.path.join(sys._MEIPASS, relative_path)
-    return os.path.join(os.path.abspath("."), relative_path)
-
-
-def load_frames(path, scale=1.0):
-    frames = []
-    for fname in sorted(os.listdir(path)):
-        if fname.endswith(".png"):
-            img = pygame.image.load(resource_path(os.path.join(path, fname))).convert_alpha()
-            if scale != 1.0:
-                new_size = (int(img.get_width() * scale), int(img.get_height() * scale))
-                img = pygame.transform.scale(img, new_size)
-            frames.append(img)
-    return frames
-
-class Skater:
+def input_bits(keys):
+    """Pressed keys to the physics input bits"""
+    bits = 0
+    if keys[pygame.K_LEFT] or keys[pygame.K_a]:
+        bits |= TURN_LEFT
+    if keys[pygame.K_RIGHT] or keys[pygame.K_d]:
+        bits |= TURN_RIGHT
+    if keys[pygame.K_UP] or keys[pygame.K_w]:
+        bits |= ACCELERATE
+    return bits
+
+class Skater(SkaterState):
     def __init__(self, spawn_point, scale=1.0):
-        self.scale = scale
-        self.idle_frames = load_frames("assets/images/thing/idle", scale)
-        self.sprint_frames = load_frames("assets/images/thing/sprint", scale)
+        super().__init__(spawn_point[0], spawn_point[1], 0.0, scale)
+        self.idle_frames = assets.frames("assets/images/thing/idle", scale)
+        self.sprint_frames = assets.frames("assets/images/thing/sprint", scale)
         self.current_frames = self.idle_frames
         self.frame_index = 0
         self.frame_timer = 0.0
         self.frame_speed = 0.15
 
-        self.pos = Vector2(spawn_point)
-        self.vx = 0.0
-        self.vy = 0.0
-        self.angle = 0.0
-        self.rect = self.idle_frames[0].get_rect(center=spawn_point)
-
-        # Scale physics parameters
-        self.accel = 90 * scale
-        self.max_speed = 300 * scale
-        self.turn_rate = 200
-        self.friction = 0.98
-
-        self.crashes = 0
+    @property
+    def pos(self):
+        return Vector2(self.x, self.y)
 
-    def update(self, keys, dt):
-        if keys[pygame.K_LEFT] or keys[pygame.K_a]:
-            self.angle -= self.turn_rate * dt
-        if keys[pygame.K_RIGHT] or keys[pygame.K_d]:
-            self.angle += self.turn_rate * dt
+    @pos.setter
+    def pos(self, value):
+        self.x, self.y = value
 
-        forward = Vector2(
-            math.cos(math.radians(self.angle - 90)),
-            math.sin(math.radians(self.angle - 90))
-        )
+    @property
+    def rect(self):
+        return self.idle_frames[0].get_rect(center=(self.x, self.y))
 
-        if keys[pygame.K_UP] or keys[pygame.K_w]:
-            self.vx += forward.x * self.accel * dt
-            self.vy += forward.y * self.accel * dt
+    def update(self, keys, dt=STEP):
+        self.apply_input(input_bits(keys), dt)
 
-        self.vx *= self.friction
-        self.vy *= self.friction
-
-        speed = math.hypot(self.vx, self.vy)
-        if speed > self.max_speed:
-            scale_factor = self.max_speed / speed
-            self.vx *= scale_factor
-            self.vy *= scale_factor
-
-        self.pos.x += self.vx * dt
-        self.pos.y += self.vy * dt
-        self.rect.center = self.pos
-
-        # Animation threshold scaled
-        if speed > 20 * self.scale:
-            self.current_frames = self.sprint_frames
-        else:
-            self.current_frames = self.idle_frames
-
-        self.frame_timer += dt
-        if self.frame_timer >= self.frame_speed:
-            self.frame_timer = 0
-            self.frame_index = (self.frame_index + 1) % len(self.current_frames)
+    def apply_input(self, bits, dt=STEP):
+        """One physics step of movement and animation for the given input bits"""
+        self.step(bits, dt)
+        self.update_animation(dt)
 
     def update_animation(self, dt):
-        """Update animation frames for remote players"""
+        """Update animation frames, also used for remote players"""
         speed = math.hypot(self.vx, self.vy)
         
         # Animation threshold scaled
@@ -99,9 +61,11 @@ class Skater:
             self.frame_timer = 0
             self.frame_index = (self.frame_index + 1) % len(self.current_frames)
 
-    def draw(self, surface, cam_x, cam_y):
+    def draw(self, surface, cam_x, cam_y, alpha=1.0):
+        """alpha: how far between the last two physics steps to draw it"""
+        x, y = self.lerp(alpha)
         frame = self.current_frames[self.frame_index]
-        rotated = pygame.transform.rotate(frame, -(self.angle))
-        rect = rotated.get_rect(center=(self.pos.x - cam_x,
-                                        self.pos.y - cam_y))
-        surface.blit(rotated, rect)
\ No newline at end of file
+        rotated = rotation_cache.get(frame, -(self.angle))
+        rect = rotated.get_rect(center=(x - cam_x,
+                                        y - cam_y))
+        surface.blit(rotated, rect)
@@ -0,0 +1,125 @@
+import numpy as np
+from physics import SkaterState, STEP, TILE_SIZE, TURN_LEFT, TURN_RIGHT, ACCELERATE, per_step
+from trackgrid import CONE_BOUNCE
+
+
+def pixel(v):
+    """physics.pixel for arrays"""
+    return np.where(v >= 0, np.floor(v + 0.5), -np.floor(0.5 - v)).astype(np.int64)
+
+
+class SkaterBatch:
+    """Many skaters as arrays, stepped together.
+
+    Same physics as SkaterState.step + TrackGrid.apply_surface_effects, for
+    servers with big lobbies and tools running lots of ghosts. Every skater
+    in a batch shares one scale.
+    """
+
+    def __init__(self, count, scale=1.0):
+        template = SkaterState(0.0, 0.0, 0.0, scale)
+        self.scale = scale
+        self.size = template.size
+        self.accel = template.accel
+        self.max_speed = template.max_speed
+        self.turn_rate = template.turn_rate
+        self.friction = template.friction
+        self.tilesize = int(TILE_SIZE * scale)
+
+        self.x = np.zeros(count)
+        self.y = np.zeros(count)
+        self.vx = np.zeros(count)
+        self.vy = np.zeros(count)
+        self.angle = np.zeros(count)
+        self.crashes = np.zeros(count, dtype=np.int64)
+        self.bits = np.zeros(count, dtype=np.uint8)  # input for the next step
+
+    @classmethod
+    def from_states(cls, states, scale=1.0):
+        batch = cls(len(states), scale)
+        for i, s in enumerate(states):
+            batch.set_state(i, s.get_state())
+        return batch
+
+    def __len__(self):
+        return len(self.x)
+
+    def get_state(self, i):
+        return {'x': float(self.x[i]), 'y': float(self.y[i]), 'angle': float(self.angle[i]),
+                'vx': float(self.vx[i]), 'vy': float(self.vy[i]), 'crashes': int(self.crashes[i])}
+
+    def set_state(self, i, state):
+        self.x[i] = state['x']
+        self.y[i] = state['y']
+        self.angle[i] = state['angle']
+        self.vx[i] = state['vx']
+        self.vy[i] = state['vy']
+        self.crashes[i] = state['crashes']
+
+    def step(self, dt=STEP):
+        """Move every skater by one step of its input bits, returns the speeds"""
+        bits = self.bits
+        turn = self.turn_rate * dt
+        self.angle = np.where(bits & TURN_LEFT != 0, self.angle - turn, self.angle)
+        self.angle = np.where(bits & TURN_RIGHT != 0, self.angle + turn, self.angle)
+
+        accelerate = bits & ACCELERATE != 0
+        heading = np.radians(self.angle - 90)
+        self.vx = np.where(accelerate, self.vx + np.cos(heading) * self.accel * dt, self.vx)
+        self.vy = np.where(accelerate, self.vy + np.sin(heading) * self.accel * dt, self.vy)
+
+        friction = per_step(self.friction, dt)
+        self.vx *= friction
+        self.vy *= friction
+
+        speed = np.hypot(self.vx, self.vy)
+        over = speed > self.max_speed
+        if over.any():
+            scale_factor = self.max_speed / speed[over]
+            self.vx[over] *= scale_factor
+            self.vy[over] *= scale_factor
+
+        self.x += self.vx * dt
+        self.y += self.vy * dt
+        return speed
+
+    def apply_surface_effects(self, grid, dt=STEP):
+        """Apply the tile under each skater. Returns a bool array, True for
+        the skaters on the finish line"""
+        tilesize = self.tilesize
+        cells = np.frombuffer(grid.buffer(), dtype=np.uint8).reshape(grid.height, grid.width)
+        friction = np.array(grid.friction)
+        solid = np.array(grid.solid, dtype=bool)
+        finish = np.array(grid.finish, dtype=bool)
+
+        gx = np.floor(self.x / tilesize).astype(np.int64)
+        gy = np.floor(self.y / tilesize).astype(np.int64)
+        inside = (gx >= 0) & (gx < grid.width) & (gy >= 0) & (gy < grid.height)
+        tid = np.zeros(len(self), dtype=np.intp)
+        tid[inside] = cells[gy[inside], gx[inside]]
+
+        tile_friction = friction[tid]
+        slides = inside & (tile_friction != 1.0)
+        if slides.any():
+            factor = per_step(tile_friction[slides], dt)
+            self.vx[slides] *= factor
+            self.vy[slides] *= factor
+
+        blocked = inside & ~slides & solid[tid]
+        if blocked.any():
+            # Only skaters whose box overlaps the cone tile
+            i = np.flatnonzero(blocked)
+            half = self.size//2
+            rect_left = pixel(self.x[i]) - half
+            rect_top = pixel(self.y[i]) - half
+            left, top = gx[i]*tilesize, gy[i]*tilesize
+            hit = ((rect_left < left + tilesize) & (rect_left + self.size > left)
+                   & (rect_top < top + tilesize) & (rect_top + self.size > top))
+            i, rect_left, rect_top, left, top = i[hit], rect_left[hit], rect_top[hit], left[hit], top[hit]
+            self.vx[i] *= CONE_BOUNCE
+            self.vy[i] *= CONE_BOUNCE
+            self.x[i] = np.where(rect_left + half < left + tilesize//2, left - half, left + tilesize + half)
+            self.y[i] = np.where(rect_top + half < top + tilesize//2, top - half, top + tilesize + half)
+            self.crashes[i] += 1
+
+        return inside & ~slides & ~solid[tid] & finish[tid]
@@ -0,0 +1,38 @@
+import pygame
+from collections import OrderedDict
+
+ANGLE_STEPS = 360
+MAX_ROTATIONS = 4096
+
+
+class RotationCache:
+    """Rotated copies of sprite frames, keyed by (frame, quantized angle)"""
+
+    def __init__(self, steps=ANGLE_STEPS, max_entries=MAX_ROTATIONS):
+        self.steps = steps
+        self.max_entries = max_entries
+        self.cache = OrderedDict()
+
+    def get(self, frame, angle):
+        """Same as pygame.transform.rotate(frame, angle), snapped to the nearest step"""
+        bucket = round(angle * self.steps / 360) % self.steps
+        key = (frame, bucket)
+        rotated = self.cache.get(key)
+        if rotated is not None:
+            self.cache.move_to_end(key)
+            return rotated
+        rotated = pygame.transform.rotate(frame, bucket * 360 / self.steps)
+        self.cache[key] = rotated
+        if len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+        return rotated
+
+    def warm(self, frames):
+        """Pre-render every step for the given frames"""
+        for frame in frames:
+            for bucket in range(self.steps):
+                self.get(frame, bucket * 360 / self.steps)
+
+
+# Shared by every skater
+rotation_cache = RotationCache()
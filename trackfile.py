@@ -0,0 +1,133 @@
+import json
+import mmap
+import os
+import struct
+import sys
+import zlib
+from trackgrid import TrackGrid
+
+# Binary track layout (little endian):
+#   header   magic, version, flags, width, height, palette size
+#   palette  per entry: u8 length + utf-8 tile name
+#   body     width*height uint8 palette indices, row major
+#            (with FLAG_ZLIB: u32 compressed length + zlib stream)
+MAGIC = b"IDTK"
+VERSION = 1
+FLAG_ZLIB = 1
+HEADER = struct.Struct("<4sBBIIB")
+BODY_LEN = struct.Struct("<I")
+
+# Uncompressed tracks bigger than this are paged in from the file instead
+# of being loaded whole (see trackstore)
+PAGED_BYTES = 16 * 1024 * 1024
+
+TRACK_EXT = ".trk"
+LEGACY_EXT = ".json"
+
+
+def journal_path(path):
+    """Where the editor autosaves unsaved edits of a track (see autosave)"""
+    return path + ".journal"
+
+
+def drop_journal(path):
+    """Forget autosaved edits of an older track at path, called whenever a
+    new track file is written there"""
+    try:
+        os.remove(journal_path(path))
+    except FileNotFoundError:
+        pass
+
+
+def is_track_file(fname):
+    return fname.endswith(TRACK_EXT) or fname.endswith(LEGACY_EXT)
+
+
+def _parse_header(buf):
+    """Returns (flags, width, height, palette, body offset)"""
+    if len(buf) < HEADER.size:
+        raise ValueError("Track file is too short")
+    magic, version, flags, width, height, count = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a track file")
+    if version > VERSION:
+        raise ValueError(f"Track format version {version} is newer than supported ({VERSION})")
+    offset = HEADER.size
+    palette = []
+    for _ in range(count):
+        n = buf[offset]
+        palette.append(bytes(buf[offset+1:offset+1+n]).decode("utf-8"))
+        offset += 1 + n
+    return flags, width, height, palette, offset
+
+
+def load_track(path, paged=None):
+    """Load a track as a TrackGrid, reading both binary and legacy .json files.
+
+    paged=None pages big uncompressed tracks from the file (read-only),
+    True always does, False always loads the whole track (for editing).
+    """
+    if path.endswith(LEGACY_EXT):
+        with open(path, "r") as f:
+            return TrackGrid.from_rows(json.load(f))
+
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            flags, width, height, palette, offset = _parse_header(mm)
+            size = width * height
+            if not flags & FLAG_ZLIB and (paged or (paged is None and size > PAGED_BYTES)):
+                from trackstore import PagedTrackGrid
+                return PagedTrackGrid(path)
+            if flags & FLAG_ZLIB:
+                (clen,) = BODY_LEN.unpack_from(mm, offset)
+                offset += BODY_LEN.size
+                cells = bytearray(zlib.decompress(mm[offset:offset+clen]))
+            else:
+                cells = bytearray(mm[offset:offset+size])
+    if len(cells) != size:
+        raise ValueError("Track body is truncated")
+    return TrackGrid(width, height, palette, cells)
+
+
+def write_header(f, width, height, palette, flags=0):
+    f.write(HEADER.pack(MAGIC, VERSION, flags, width, height, len(palette)))
+    for name in palette:
+        encoded = name.encode("utf-8")
+        f.write(bytes([len(encoded)]) + encoded)
+
+
+def save_track(path, grid, compress=False):
+    """Save a TrackGrid, as legacy JSON if the path ends in .json"""
+    drop_journal(path)
+    if path.endswith(LEGACY_EXT):
+        with open(path, "w") as f:
+            json.dump(grid.to_rows(), f)
+        return
+
+    with open(path, "wb") as f:
+        write_header(f, grid.width, grid.height, grid.palette,
+                     FLAG_ZLIB if compress else 0)
+        if compress:
+            body = zlib.compress(bytes(grid.cells))
+            f.write(BODY_LEN.pack(len(body)))
+            f.write(body)
+        else:
+            f.write(grid.cells)
+
+
+def convert_track(src, dst=None, compress=False):
+    """One-shot conversion of a legacy .json track to the binary format"""
+    if dst is None:
+        dst = os.path.splitext(src)[0] + TRACK_EXT
+    save_track(dst, load_track(src), compress)
+    return dst
+
+
+if __name__ == "__main__":
+    # python trackfile.py maps/mytrack.json [--compress]
+    args = [a for a in sys.argv[1:] if a != "--compress"]
+    if not args:
+        print("Usage: python trackfile.py <track.json>... [--compress]")
+        sys.exit(1)
+    for src in args:
+        print(f"{src} -> {convert_track(src, compress='--compress' in sys.argv)}")
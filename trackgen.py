@@ -0,0 +1,168 @@
+import os
+import sys
+import time
+import zlib
+import numpy as np
+from trackfile import write_header, drop_journal, FLAG_ZLIB, BODY_LEN
+
+# Size of the blank track the menu used to create (960x540 screens of 32px tiles, 16 of them)
+DEFAULT_WIDTH = (960//32)*16
+DEFAULT_HEIGHT = (540//32)*16
+
+PALETTE = ["snow1", "ice1", "ice2", "ice3", "snow2", "cono", "start", "finish"]
+OFF, ICE1, ICE2, ICE3, SNOW, CONE, START, FINISH = range(len(PALETTE))
+ZONES = np.array([ICE1, ICE2, ICE3, SNOW], dtype=np.uint8)
+ZONE_WEIGHTS = [0.45, 0.2, 0.2, 0.15]
+
+CONTROL_SPACING = 24   # tiles between spline control points along the course
+MIN_HALF_WIDTH = 3     # course half width in tiles, not counting the cone walls
+MAX_HALF_WIDTH = 10
+MAX_DRIFT = 0.5        # sideways tiles per tile along the course
+END_MARGIN = 6         # tiles between the map edge and the start / finish line
+SLALOM_GAP = 10        # tiles between slalom cones
+MIN_ACROSS = 2*MIN_HALF_WIDTH + 6  # narrowest map side a course fits across
+MIN_LENGTH = 2*END_MARGIN + 2      # shortest side that holds the start and finish
+BAND_BYTES = 1 << 20   # rows are generated and written about this many tiles at a time
+
+
+def catmull_rom(points, spacing, length):
+    """Smooth curve through points placed every spacing tiles, sampled per tile"""
+    u = np.arange(length) / spacing
+    k = np.minimum(u.astype(np.int64), len(points) - 2)
+    t = u - k
+    p = np.concatenate(([points[0]], points, [points[-1], points[-1]]))
+    p0, p1, p2, p3 = p[k], p[k+1], p[k+2], p[k+3]
+    return 0.5 * (2*p1 + (p2 - p0)*t + (2*p0 - 5*p1 + 4*p2 - p3)*t*t
+                  + (3*p1 - p0 - 3*p2 + p3)*t*t*t)
+
+
+class CourseProfile:
+    """Everything about the course as arrays along its length (one entry per
+    tile), so any band of rows can be generated on its own. Memory is linear
+    in the course length, never width*height."""
+
+    def __init__(self, width, height, seed=0):
+        rng = np.random.default_rng(seed)
+        self.width = width
+        self.height = height
+        # Skaters spawn facing up, so the course runs bottom to top. Only a map
+        # too narrow or too short for that gets a left to right course.
+        self.vertical = (width >= MIN_ACROSS and height >= MIN_LENGTH) or height > width
+        length, across = (height, width) if self.vertical else (width, height)
+        self.length = length
+
+        max_half = max(1, min(MAX_HALF_WIDTH, (across - 4) // 2 - 1))
+        min_half = min(MIN_HALF_WIDTH, max_half)
+        controls = length // CONTROL_SPACING + 2
+        half = catmull_rom(rng.uniform(min_half, max_half, controls), CONTROL_SPACING, length)
+        self.half = np.clip(half, min_half, max_half)
+        # The line wanders at most MAX_DRIFT tiles sideways per tile, so each
+        # cross-section overlaps the next one and the course stays connected
+        low, high = max_half + 2, max(max_half + 2, across - 3 - max_half)
+        points = np.empty(controls)
+        points[0] = rng.uniform(low, high)
+        steps = rng.uniform(-1, 1, controls) * MAX_DRIFT * CONTROL_SPACING
+        for k in range(1, controls):
+            points[k] = min(high, max(low, points[k-1] + steps[k]))
+        self.center = np.clip(catmull_rom(points, CONTROL_SPACING, length), low, high)
+
+        # Surface zones: runs of 20-80 tiles of one surface
+        self.zone = np.empty(length, dtype=np.uint8)
+        u = 0
+        while u < length:
+            run = int(rng.integers(20, 81))
+            self.zone[u:u+run] = rng.choice(ZONES, p=ZONE_WEIGHTS)
+            u += run
+
+        # Slaloms: some stretches get cones alternating either side of the line
+        self.cone = np.full(length, -1, dtype=np.int64)
+        u = END_MARGIN + 20
+        side = 1
+        while u < length - END_MARGIN - 20:
+            run = int(rng.integers(60, 200))
+            if rng.random() < 0.4:
+                for c in range(u, min(u + run, length - END_MARGIN - 20), SLALOM_GAP):
+                    if self.half[c] >= 3:
+                        self.cone[c] = int(round(self.center[c] + side * self.half[c] * 0.5))
+                        side = -side
+            u += run
+
+        # Finish line two tiles thick, the second row on the far side
+        if self.vertical:
+            self.start_u, self.finish_u, self.finish_dir = length - 1 - END_MARGIN, END_MARGIN, -1
+        else:
+            self.start_u, self.finish_u, self.finish_dir = END_MARGIN, length - 1 - END_MARGIN, 1
+        self.start_v = int(round(self.center[self.start_u]))
+
+    def band(self, y0, y1):
+        """Tile ids for rows y0..y1-1 as a uint8 array"""
+        ys = np.arange(y0, y1)
+        xs = np.arange(self.width)
+        if self.vertical:
+            u, v = ys[:, None], xs[None, :]
+        else:
+            u, v = xs[None, :], ys[:, None]
+
+        dist = np.abs(v - self.center[u])
+        half = self.half[u]
+        on = dist <= half
+        out = np.where(on, self.zone[u], OFF).astype(np.uint8)
+        walls = (dist > half) & (dist <= half + 1)
+        walls |= on & ((u == 0) | (u == self.length - 1))
+        out[walls] = CONE
+        out[on & (v == self.cone[u])] = CONE  # slaloms
+        out[on & ((u == self.finish_u) | (u == self.finish_u + self.finish_dir))] = FINISH
+        out[(u == self.start_u) & (v == self.start_v)] = START
+        return out
+
+
+def generate_track(path, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT, seed=0, compress=False):
+    """Write a generated track straight to a track file, a band of rows at a
+    time. Returns stats with the throughput."""
+    started = time.perf_counter()
+    profile = CourseProfile(width, height, seed)
+    band_rows = max(1, BAND_BYTES // width)
+    root, ext = os.path.splitext(path)
+    tmp = root + ".tmp" + ext
+    with open(tmp, "wb") as f:
+        write_header(f, width, height, PALETTE, FLAG_ZLIB if compress else 0)
+        if compress:
+            length_at = f.tell()
+            f.write(BODY_LEN.pack(0))  # patched once the size is known
+            compressor = zlib.compressobj()
+        for y in range(0, height, band_rows):
+            data = profile.band(y, min(height, y + band_rows)).tobytes()
+            f.write(compressor.compress(data) if compress else data)
+        if compress:
+            f.write(compressor.flush())
+            end = f.tell()
+            f.seek(length_at)
+            f.write(BODY_LEN.pack(end - length_at - BODY_LEN.size))
+    os.replace(tmp, path)
+    drop_journal(path)
+    elapsed = time.perf_counter() - started
+    return {
+        'tiles': width * height,
+        'seconds': elapsed,
+        'tiles_per_sec': width * height / elapsed if elapsed else 0.0,
+        'bytes': os.path.getsize(path)
+    }
+
+
+if __name__ == "__main__":
+    # python trackgen.py maps/gen.trk [--size WxH] [--seed N] [--compress]
+    args = sys.argv[1:]
+    if not args:
+        print("Usage: python trackgen.py <track.trk> [--size WxH] [--seed N] [--compress]")
+        sys.exit(1)
+
+    def option(name, default):
+        if name in args:
+            return args[args.index(name) + 1]
+        return default
+
+    width, height = (int(n) for n in option("--size", f"{DEFAULT_WIDTH}x{DEFAULT_HEIGHT}").split("x"))
+    result = generate_track(args[0], width, height, int(option("--seed", 0)), "--compress" in args)
+    print(f"{args[0]}: {width}x{height} tiles, {result['bytes']} bytes")
+    print(f"{result['tiles']} tiles in {result['seconds']:.3f}s, "
+          f"{result['tiles_per_sec']/1e6:.1f}M tiles/s")
@@ -0,0 +1,206 @@
+from physics import per_step, STEP
+
+# Velocity multipliers per physics step for the surface types
+SNOW_FRICTION = 0.95
+ICE_FRICTION = 1.02
+CONE_BOUNCE = -0.4
+
+# Cones are bucketed by chunks of this many tiles for obstacle queries
+INDEX_CHUNK = 16
+
+
+def tile_props(name):
+    """(friction, solid, finish) for a tile name"""
+    if "snow" in name:
+        return SNOW_FRICTION, False, False
+    if "ice" in name:
+        return ICE_FRICTION, False, False
+    if "cono" in name:
+        return 1.0, True, False
+    if "finish" in name:
+        return 1.0, False, True
+    return 1.0, False, False
+
+
+class TrackGrid:
+    """Track tiles stored as one byte per cell, indexing into a palette of tile names"""
+
+    def __init__(self, width, height, palette, cells):
+        self.width = width
+        self.height = height
+        self.palette = []
+        self.ids = {}
+        # Lookup tables indexed by tile id
+        self.friction = []
+        self.solid = []
+        self.finish = []
+        for name in palette:
+            self.tile_id(name)
+        self.cells = cells  # bytearray, row major
+        self._build_index()
+
+    @classmethod
+    def filled(cls, width, height, name="ice1"):
+        return cls(width, height, [name], bytearray(width * height))
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build a grid from the legacy list of lists of tile names"""
+        palette = []
+        ids = {}
+        cells = bytearray()
+        for row in rows:
+            for name in row:
+                if name not in ids:
+                    ids[name] = len(palette)
+                    palette.append(name)
+            cells.extend([ids[name] for name in row])
+        return cls(len(rows[0]), len(rows), palette, cells)
+
+    def to_rows(self):
+        w = self.width
+        return [[self.palette[i] for i in self.cells[y*w:(y+1)*w]]
+                for y in range(self.height)]
+
+    def tile_id(self, name):
+        """Palette index for a tile name, adding it to the palette if needed"""
+        tid = self.ids.get(name)
+        if tid is None:
+            if len(self.palette) >= 256:
+                raise ValueError("Too many tile types in one track")
+            tid = len(self.palette)
+            self.palette.append(name)
+            self.ids[name] = tid
+            friction, solid, finish = tile_props(name)
+            self.friction.append(friction)
+            self.solid.append(solid)
+            self.finish.append(finish)
+        return tid
+
+    def _build_index(self):
+        """Scan once for start, finish and cone cells; set() keeps it up to date"""
+        self.starts = set()
+        self.finish_cells = set()
+        self.cones = {}  # {(chunk x, chunk y): {(x, y), ...}}
+        for tid, name in enumerate(self.palette):
+            if not (name == "start" or self.finish[tid] or self.solid[tid]):
+                continue
+            i = self.cells.find(tid)
+            while i >= 0:
+                self._index_add(i % self.width, i // self.width, tid)
+                i = self.cells.find(tid, i + 1)
+
+    def _index_add(self, x, y, tid):
+        if self.palette[tid] == "start":
+            self.starts.add((x, y))
+        elif self.finish[tid]:
+            self.finish_cells.add((x, y))
+        elif self.solid[tid]:
+            key = (x // INDEX_CHUNK, y // INDEX_CHUNK)
+            self.cones.setdefault(key, set()).add((x, y))
+
+    def _index_remove(self, x, y, tid):
+        if self.palette[tid] == "start":
+            self.starts.discard((x, y))
+        elif self.finish[tid]:
+            self.finish_cells.discard((x, y))
+        elif self.solid[tid]:
+            key = (x // INDEX_CHUNK, y // INDEX_CHUNK)
+            bucket = self.cones.get(key)
+            if bucket:
+                bucket.discard((x, y))
+                if not bucket:
+                    del self.cones[key]
+
+    @property
+    def start(self):
+        """Start cell (x, y), the topmost-leftmost one if there are several"""
+        if not self.starts:
+            return None
+        x, y = min(self.starts, key=lambda c: (c[1], c[0]))
+        return x, y
+
+    def cones_in(self, x0, y0, x1, y1):
+        """Cone cells inside the tile rectangle [x0, x1) x [y0, y1)"""
+        found = []
+        for cy in range(max(0, y0) // INDEX_CHUNK, (y1 - 1) // INDEX_CHUNK + 1):
+            for cx in range(max(0, x0) // INDEX_CHUNK, (x1 - 1) // INDEX_CHUNK + 1):
+                for x, y in self.cones.get((cx, cy), ()):
+                    if x0 <= x < x1 and y0 <= y < y1:
+                        found.append((x, y))
+        return found
+
+    def buffer(self):
+        """The cells as one flat buffer, for numpy"""
+        return self.cells
+
+    def close(self):
+        """Nothing to release in memory, PagedTrackGrid closes its file here"""
+
+    def in_bounds(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def get(self, x, y):
+        return self.palette[self.cells[y*self.width + x]]
+
+    def set(self, x, y, name):
+        i = y*self.width + x
+        tid = self.tile_id(name)
+        old = self.cells[i]
+        if old == tid:
+            return
+        self._index_remove(x, y, old)
+        self.cells[i] = tid
+        self._index_add(x, y, tid)
+
+    def write_cells(self, indices, values):
+        """Set many cells by index to tile ids in one pass (fills, undo)"""
+        cells = self.cells
+        w = self.width
+        indexed = [name == "start" or finish or solid
+                   for name, finish, solid in zip(self.palette, self.finish, self.solid)]
+        for i, tid in zip(indices, values):
+            old = cells[i]
+            if old == tid:
+                continue
+            if indexed[old]:
+                self._index_remove(i % w, i // w, old)
+            cells[i] = tid
+            if indexed[tid]:
+                self._index_add(i % w, i // w, tid)
+
+    def apply_surface_effects(self, skater, tilesize, on_crash=None, dt=STEP):
+        """Apply the tile under the skater (any SkaterState). Returns True when
+        it is on the finish line"""
+        gx, gy = int(skater.x//tilesize), int(skater.y//tilesize)
+        if not (0 <= gy < self.height and 0 <= gx < self.width):
+            return False
+        tid = self.cells[gy*self.width + gx]
+
+        friction = self.friction[tid]
+        if friction != 1.0:
+            friction = per_step(friction, dt)
+            skater.vx *= friction
+            skater.vy *= friction
+        elif self.solid[tid]:
+            rect_left, rect_top, rect_right, rect_bottom = skater.body()
+            left, top = gx*tilesize, gy*tilesize
+            right, bottom = left + tilesize, top + tilesize
+            if rect_left < right and rect_right > left and rect_top < bottom and rect_bottom > top:
+                skater.vx *= CONE_BOUNCE
+                skater.vy *= CONE_BOUNCE
+                half = skater.size//2
+                if rect_left + half < left + tilesize//2:
+                    skater.x = left - half
+                else:
+                    skater.x = right + half
+                if rect_top + half < top + tilesize//2:
+                    skater.y = top - half
+                else:
+                    skater.y = bottom + half
+                skater.crashes += 1
+                if on_crash:
+                    on_crash()
+        elif self.finish[tid]:
+            return True
+        return False
@@ -0,0 +1,138 @@
+import mmap
+from collections import OrderedDict
+from trackgrid import TrackGrid
+from trackfile import _parse_header, FLAG_ZLIB
+
+PAGE_TILES = 64       # pages are PAGE_TILES x PAGE_TILES tiles
+MAX_PAGES = 256       # 1 MB of pages at most
+SCAN_BYTES = 1 << 22  # the start/finish/cone scan reads the body this much at a time
+FAULT_AROUND = 1 << 20  # readahead maps pages this far around a fault
+
+
+class PagedCells:
+    """Read-only stand-in for TrackGrid.cells over a memory-mapped track body.
+
+    Tiles are copied out of the file a square page at a time and kept in an
+    LRU, so only the pages around the skaters and the camera stay in memory
+    whatever the size of the track. Row slices (what ChunkCache bakes from)
+    are put together from the same pages.
+    """
+
+    def __init__(self, mm, offset, width, height, page_tiles=PAGE_TILES, max_pages=MAX_PAGES):
+        self.mm = mm
+        self.offset = offset
+        self.width = width
+        self.height = height
+        self.page_tiles = page_tiles
+        self.max_pages = max_pages
+        self.pages = OrderedDict()  # {(px, py): bytes, page width x page height}
+        self.loads = 0
+
+    def __len__(self):
+        return self.width * self.height
+
+    def page(self, px, py):
+        key = (px, py)
+        data = self.pages.get(key)
+        if data is not None:
+            self.pages.move_to_end(key)
+            return data
+        pt, w = self.page_tiles, self.width
+        x0, y0 = px*pt, py*pt
+        x1, y1 = min(w, x0 + pt), min(self.height, y0 + pt)
+        start = self.offset + x0
+        data = b"".join(self.mm[start + y*w:start + y*w + x1 - x0] for y in range(y0, y1))
+        self.release(self.offset + y0*w, (y1 - y0)*w)
+        self.pages[key] = data
+        self.loads += 1
+        if len(self.pages) > self.max_pages:
+            self.pages.popitem(last=False)
+        return data
+
+    def release(self, start, length):
+        """Let the OS drop the mapped file pages, the copy is all we keep"""
+        if hasattr(self.mm, "madvise") and hasattr(mmap, "MADV_DONTNEED"):
+            # Faults map their neighbours as well, drop those too
+            start, end = max(0, start - FAULT_AROUND), min(len(self.mm), start + length + FAULT_AROUND)
+            start -= start % mmap.PAGESIZE
+            self.mm.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self._row_slice(i)
+        if i < 0:
+            i += len(self)
+        y, x = divmod(i, self.width)
+        pt = self.page_tiles
+        page_w = min(pt, self.width - (x - x % pt))
+        return self.page(x // pt, y // pt)[(y % pt)*page_w + x % pt]
+
+    def _row_slice(self, s):
+        start, stop, step = s.indices(len(self))
+        y, x0 = divmod(start, self.width)
+        x1 = x0 + stop - start
+        if x1 <= x0:
+            return b""
+        if step != 1 or x1 > self.width:
+            # Not a piece of one row, read it straight from the file
+            return self.mm[self.offset + start:self.offset + stop:step]
+        pt = self.page_tiles
+        parts = []
+        for px in range(x0 // pt, (x1 - 1) // pt + 1):
+            page_x = px*pt
+            page_w = min(pt, self.width - page_x)
+            row = (y % pt)*page_w
+            data = self.page(px, y // pt)
+            parts.append(data[row + max(x0, page_x) - page_x:row + min(x1, page_x + page_w) - page_x])
+        return b"".join(parts)
+
+
+class PagedTrackGrid(TrackGrid):
+    """TrackGrid for an uncompressed .trk file too big to load whole. The
+    cells are paged in from the file as they are used. Read-only."""
+
+    def __init__(self, path, page_tiles=PAGE_TILES, max_pages=MAX_PAGES):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        flags, width, height, palette, offset = _parse_header(self.mm)
+        if flags & FLAG_ZLIB:
+            self.mm.close()
+            raise ValueError("Compressed tracks can't be paged")
+        if len(self.mm) < offset + width*height:
+            self.mm.close()
+            raise ValueError("Track body is truncated")
+        super().__init__(width, height, palette,
+                         PagedCells(self.mm, offset, width, height, page_tiles, max_pages))
+
+    def _build_index(self):
+        """Same as TrackGrid, scanning the file a block at a time"""
+        self.starts = set()
+        self.finish_cells = set()
+        self.cones = {}
+        targets = [tid for tid, name in enumerate(self.palette)
+                   if name == "start" or self.finish[tid] or self.solid[tid]]
+        mm, offset, size = self.mm, self.cells.offset, self.width * self.height
+        for block in range(0, size, SCAN_BYTES):
+            end = offset + min(size, block + SCAN_BYTES)
+            for tid in targets:
+                needle = bytes([tid])
+                i = mm.find(needle, offset + block, end)
+                while i >= 0:
+                    i -= offset
+                    self._index_add(i % self.width, i // self.width, tid)
+                    i = mm.find(needle, offset + i + 1, end)
+            self.cells.release(offset + block, end - offset - block)
+
+    def buffer(self):
+        return memoryview(self.mm)[self.cells.offset:self.cells.offset + self.width*self.height]
+
+    def set(self, x, y, name):
+        raise TypeError("Paged tracks are read-only")
+
+    def write_cells(self, indices, values):
+        raise TypeError("Paged tracks are read-only")
+
+    def close(self):
+        self.cells.pages.clear()
+        self.mm.close()